@@ -8,12 +8,17 @@
 """
 
 import time
-from flask import g, request
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from horseradish import factory
+from horseradish.extensions import metrics
 
 from horseradish.auth.views import mod as auth_bp
 from horseradish.users.views import mod as users_bp
 from horseradish.roles.views import mod as roles_bp
+from horseradish.api_keys.views import mod as api_keys_bp
 
 # from horseradish.practice.views import mod as practice_bp
 
@@ -43,6 +48,7 @@ HORSERADISH_BLUEPRINTS = (
     auth_bp,
     users_bp,
     roles_bp,
+    api_keys_bp,
     # practice_bp,
 )
 
@@ -56,6 +62,26 @@ def create_app(config_path=None):
     return app
 
 
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the execution context, which is discarded when the statement
+    # fails, rather than on the pooled connection
+    if context is not None:
+        context._query_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start_time", None)
+    if start is None:
+        return
+
+    # only account for queries issued while serving a request
+    if not has_app_context() or "request_start_time" not in g:
+        return
+
+    g.db_query_count = g.get("db_query_count", 0) + 1
+    g.db_query_time = g.get("db_query_time", 0) + time.perf_counter() - start
+
+
 def configure_hook(app):
     """
     :param app:
@@ -65,6 +91,10 @@ def configure_hook(app):
     from flask import jsonify
     from werkzeug.exceptions import HTTPException
 
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
     @app.errorhandler(Exception)
     def handle_error(e):
         code = 500
@@ -76,7 +106,9 @@ def configure_hook(app):
 
     @app.before_request
     def before_request():
-        g.request_start_time = time.time()
+        g.request_start_time = time.perf_counter()
+        g.db_query_count = 0
+        g.db_query_time = 0
 
     @app.after_request
     def after_request(response):
@@ -85,8 +117,26 @@ def configure_hook(app):
             return response
 
         # Get elapsed time in milliseconds
-        # elapsed = time.time() - g.request_start_time
-        # elapsed = int(round(1000 * elapsed)
-
-        # metrics could be sent here
+        elapsed = 1000 * (time.perf_counter() - g.request_start_time)
+        db_time = 1000 * g.db_query_time
+
+        tags = {
+            "endpoint": request.endpoint or "unknown",
+            "method": request.method,
+            "status": response.status_code,
+        }
+        metrics.send("request.latency", "timer", elapsed, metric_tags=tags)
+        metrics.send("request.db_time", "timer", db_time, metric_tags=tags)
+        metrics.send(
+            "request.db_queries", "histogram", g.db_query_count, metric_tags=tags
+        )
+
+        # exposes timings and query counts to clients, so off by default
+        if app.config.get("HORSERADISH_SERVER_TIMING", False):
+            response.headers.add(
+                "Server-Timing",
+                'app;dur={0:.1f}, db;dur={1:.1f};desc="{2} queries"'.format(
+                    elapsed, db_time, g.db_query_count
+                ),
+            )
         return response
@@ -5,6 +5,10 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Eric Coan <kungfury@instructure.com>
 """
+import sys
+import json
+
+from flask import current_app
 from flask_script import Manager
 from horseradish.api_keys import service as api_key_service
 from horseradish.auth.service import create_token
@@ -48,3 +52,106 @@ def revoke(aid):
     print("[-] Revoking the API Key api key.")
     api_key_service.revoke(aid=aid)
     print("[+] Successfully revoked the api key")
+
+
+def read_lines(path):
+    """
+    Yields the non-empty lines of a file, or of stdin when `path` is "-".
+
+    :param path:
+    """
+    stream = sys.stdin if path == "-" else open(path)
+    try:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def chunks(items, size):
+    """
+    Splits a list into lists of at most `size` items.
+
+    :param items:
+    :param size:
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@manager.option(
+    "-f",
+    "--file",
+    dest="path",
+    default="-",
+    help="NDJSON file with one {user_id, name, ttl} per line, - for stdin.",
+)
+def create_many(path):
+    """
+    Creates many api keys and writes their JWTs to stdout as NDJSON. Each
+    API_KEY_BATCH_MAX_SIZE keys are inserted in a single statement.
+    :return:
+    """
+    specs = [json.loads(line) for line in read_lines(path)]
+    for line, spec in enumerate(specs, 1):
+        if spec.get("user_id") is None or spec.get("ttl") is None:
+            sys.stderr.write(
+                "[!] Spec {0} needs a user_id and a ttl (-1 for forever).\n".format(
+                    line
+                )
+            )
+            sys.exit(1)
+
+    missing = api_key_service.missing_users(spec["user_id"] for spec in specs)
+    if missing:
+        sys.stderr.write(
+            "[!] Unknown user ids: {0}\n".format(", ".join(str(i) for i in missing))
+        )
+        sys.exit(1)
+
+    size = current_app.config.get("API_KEY_BATCH_MAX_SIZE", 1000)
+
+    for batch in chunks(specs, size):
+        for key in api_key_service.create_many(batch):
+            sys.stdout.write(
+                json.dumps(
+                    dict(
+                        id=key.id,
+                        name=key.name,
+                        user_id=key.user_id,
+                        ttl=key.ttl,
+                        jwt=create_token(key.user_id, key.id, key.ttl),
+                    )
+                )
+                + "\n"
+            )
+
+    sys.stderr.write("[+] Successfully created {0} api keys.\n".format(len(specs)))
+
+
+@manager.option(
+    "-f",
+    "--file",
+    dest="path",
+    default="-",
+    help="File with one API Key ID per line, - for stdin.",
+)
+def revoke_many(path):
+    """
+    Revokes many api keys and writes the outcome for each to stdout as NDJSON.
+    :return:
+    """
+    aids = [int(line) for line in read_lines(path)]
+    size = current_app.config.get("API_KEY_BATCH_MAX_SIZE", 1000)
+
+    count = 0
+    for batch in chunks(aids, size):
+        revoked = set(api_key_service.revoke_many(batch))
+        count += len(revoked)
+        for aid in batch:
+            sys.stdout.write(json.dumps(dict(id=aid, revoked=aid in revoked)) + "\n")
+
+    sys.stderr.write("[+] Successfully revoked {0} api keys.\n".format(count))
@@ -6,7 +6,7 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Eric Coan <kungfury@instructure.com>
 """
-from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, text
 
 from horseradish.database import db
 
@@ -28,3 +28,25 @@ class ApiKey(db.Model):
             iat=self.issued_at,
             revoked=self.revoked,
         )
+
+
+class TokenRevocation(db.Model):
+    """
+    One row per change that invalidates cached tokens: of an api key that
+    was revoked, updated or deleted (`api_key_id`), of a user that was
+    updated (`user_id`), or of everyone after a role change (neither).
+    Workers poll it to find out what they must forget, see
+    :mod:`horseradish.api_keys.revocations`. `changed_at` is taken from the
+    database clock, so that all workers compare it against the same clock.
+    """
+
+    __tablename__ = "token_revocations"
+    id = Column(Integer, primary_key=True)
+    api_key_id = Column(Integer)
+    user_id = Column(Integer)
+    changed_at = Column(
+        BigInteger,
+        nullable=False,
+        index=True,
+        server_default=text("extract(epoch FROM clock_timestamp())::bigint"),
+    )
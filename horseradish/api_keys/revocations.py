@@ -0,0 +1,193 @@
+"""
+.. module: horseradish.api_keys.revocations
+    :platform: Unix
+    :synopsis: Keeps what is needed to validate api key tokens in memory, and
+    learns about revoked keys and changed users by polling a change log.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+
+import time
+import threading
+
+from sqlalchemy import func, or_
+
+from horseradish import database
+from horseradish.api_keys.models import ApiKey, TokenRevocation
+from horseradish.auth.cache import invalidate_all, invalidate_api_key, invalidate_user
+from horseradish.common.cache import TTLCache
+
+
+def db_now():
+    """
+    The database clock, in epoch seconds, which is what `changed_at` is
+    stamped with.
+    """
+    return func.extract("epoch", func.clock_timestamp())
+
+
+def record_change(aid=None, user_id=None):
+    """
+    Adds a revocation row to the current transaction, so that every worker
+    drops the cached tokens of an api key, of a user, or of everyone when
+    neither is given. Must be called before the change is committed.
+
+    :param aid:
+    :param user_id:
+    """
+    database.db.session.add(TokenRevocation(api_key_id=aid, user_id=user_id))
+
+
+class RevocationIndex(object):
+    """
+    Caches the (revoked, issued_at, ttl) of api keys, so that validating a
+    token issued for an api key doesn't need its row.
+
+    Every change to a key, to a user's status or roles, or to a role adds a
+    row to ``token_revocations``. Each process polls that table at most
+    every ``API_KEY_REVOCATION_POLL_INTERVAL`` seconds and, for the rows it
+    hasn't seen yet, forgets the keys along with their cached tokens, and
+    drops the cached tokens of the users (or of everyone). Ids are not
+    committed in order, so a poll reads the rows above the highest id seen
+    so far and also re-reads the rows of the last
+    ``API_KEY_REVOCATION_OVERLAP`` seconds: a row is missed only if its
+    transaction took longer than that to commit. A revocation, deactivation
+    or role change thus reaches every worker within the poll interval. The
+    keys are cached in ``API_KEY_CACHE_SIZE`` / ``API_KEY_CACHE_TTL``.
+
+    Rows older than ``API_KEY_REVOCATION_RETENTION`` seconds are pruned,
+    and a process that hasn't polled for that long starts over with an
+    empty cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.keys = TTLCache(maxsize=10000, ttl=3600, config_prefix="API_KEY_CACHE")
+        self.interval = 5
+        self.overlap = 60
+        self.retention = 86400
+        self._reset()
+
+    def _reset(self):
+        # bumped whenever a key is forgotten, None until the first poll
+        self.generation = None
+        self._last_id = 0
+        self._seen = set()
+        self._synced_at = None
+        self._next_sync = 0
+        self._next_prune = 0
+
+    def init_app(self, app):
+        """Initializes the application with the extension.
+
+        :param app: The Flask application object.
+        """
+        self.interval = app.config.get("API_KEY_REVOCATION_POLL_INTERVAL", 5)
+        self.overlap = app.config.get("API_KEY_REVOCATION_OVERLAP", 60)
+        self.retention = app.config.get("API_KEY_REVOCATION_RETENTION", 86400)
+        self.keys.init_app(app)
+        self._reset()
+
+    def sync(self):
+        """
+        Forgets the keys changed since the last poll. A no-op until the poll
+        interval is over, or while another thread is polling.
+        """
+        now = time.monotonic()
+        if now < self._next_sync or not self._lock.acquire(False):
+            return
+
+        try:
+            self._next_sync = now + self.interval
+
+            if self._synced_at is None or now - self._synced_at > self.retention:
+                # the rows we missed may have been pruned meanwhile
+                self.keys.clear()
+                self.generation = None
+                self._last_id = 0
+                self._seen = set()
+
+            rows = database.db.session.query(
+                TokenRevocation.id, TokenRevocation.api_key_id, TokenRevocation.user_id
+            ).filter(
+                or_(
+                    TokenRevocation.id > self._last_id,
+                    TokenRevocation.changed_at >= db_now() - self.overlap,
+                )
+            )
+
+            seen = set()
+            for rid, aid, user_id in rows:
+                seen.add(rid)
+                if self.generation is None or rid in self._seen:
+                    continue
+                if aid is not None:
+                    self.forget(aid)
+                elif user_id is not None:
+                    invalidate_user(user_id)
+                else:
+                    invalidate_all()
+
+            if self.generation is None:
+                # nothing we know of yet can be stale
+                self.generation = 0
+            self._seen = seen
+            self._last_id = max(seen, default=self._last_id)
+            self._synced_at = now
+
+            if now >= self._next_prune:
+                self._next_prune = now + 3600
+                self.prune()
+        finally:
+            self._lock.release()
+
+    def prune(self):
+        """
+        Deletes the rows older than the retention, in its own
+        transaction.
+        """
+        table = TokenRevocation.__table__
+        database.db.engine.execute(
+            table.delete().where(table.c.changed_at < db_now() - self.retention)
+        )
+
+    def forget(self, aid):
+        """
+        Drops what we know about an api key and the tokens issued for it.
+
+        :param aid:
+        """
+        self.keys.pop(aid)
+        invalidate_api_key(aid)
+        if self.generation is not None:
+            self.generation += 1
+
+    def get(self, aid):
+        """
+        Returns (revoked, issued_at, ttl) for an api key. A key that doesn't
+        exist anymore is reported as revoked.
+
+        :param aid:
+        :return:
+        """
+        key = self.keys.get(aid)
+        if key is not None:
+            return key
+
+        generation = self.generation
+        # cached until the key changes again, so a stale replica won't do
+        with database.primary():
+            api_key = database.get(ApiKey, aid)
+        if api_key is None:
+            key = (True, None, None)
+        else:
+            key = (api_key.revoked, api_key.issued_at, api_key.ttl)
+
+        # a poll that ran meanwhile may have been about this very key
+        if generation is not None and generation == self.generation:
+            self.keys.set(aid, key)
+        return key
+
+
+revocation_index = RevocationIndex()
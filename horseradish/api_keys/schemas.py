@@ -37,6 +37,26 @@ class ApiKeyRevokeSchema(HorseradishInputSchema):
     issued_at = fields.Integer(required=False)
 
 
+class ApiKeyUserSchema(HorseradishInputSchema):
+    id = fields.Integer(required=True)
+
+
+class ApiKeyBatchSpecSchema(HorseradishInputSchema):
+    name = fields.String(required=False)
+    user = fields.Nested(
+        ApiKeyUserSchema, missing=current_user_id, default=current_user_id
+    )
+    ttl = fields.Integer(required=True)
+
+
+class ApiKeyBatchInputSchema(HorseradishInputSchema):
+    keys = fields.Nested(ApiKeyBatchSpecSchema, many=True, required=True)
+
+
+class ApiKeyBatchRevokeSchema(HorseradishInputSchema):
+    ids = fields.List(fields.Integer(), required=True)
+
+
 class UserApiKeyInputSchema(HorseradishInputSchema):
     name = fields.String(required=False)
     ttl = fields.Integer()
@@ -57,6 +77,8 @@ class ApiKeyDescribedOutputSchema(HorseradishOutputSchema):
 
 api_key_input_schema = ApiKeyInputSchema()
 api_key_revoke_schema = ApiKeyRevokeSchema()
+api_key_batch_input_schema = ApiKeyBatchInputSchema()
+api_key_batch_revoke_schema = ApiKeyBatchRevokeSchema()
 api_key_output_schema = ApiKeyOutputSchema()
 api_keys_output_schema = ApiKeyDescribedOutputSchema(many=True)
 api_key_described_output_schema = ApiKeyDescribedOutputSchema()
@@ -5,8 +5,14 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Eric Coan <kungfury@instructure.com>
 """
+from datetime import datetime
+
+from sqlalchemy import false
+
 from horseradish import database
-from horseradish.api_keys.models import ApiKey
+from horseradish.api_keys.models import ApiKey, TokenRevocation
+from horseradish.api_keys.revocations import record_change, revocation_index
+from horseradish.users.models import User
 
 
 def get(aid):
@@ -24,7 +30,10 @@ def delete(access_key):
     :param access_key:
     :return:
     """
+    aid = access_key.id
+    record_change(aid)
     database.delete(access_key)
+    revocation_index.forget(aid)
 
 
 def revoke(aid):
@@ -34,9 +43,49 @@ def revoke(aid):
     :return:
     """
     api_key = get(aid)
-    setattr(api_key, "revoked", False)
+    setattr(api_key, "revoked", True)
+    record_change(api_key.id)
+
+    api_key = database.update(api_key)
+    revocation_index.forget(api_key.id)
+    return api_key
+
 
-    return database.update(api_key)
+def revoke_many(aids, user_id=None):
+    """
+    Revokes many api keys with a single UPDATE ... RETURNING, and logs the
+    revocations in the same transaction. Keys that don't exist, are already
+    revoked, or don't belong to `user_id` (when given) are left alone.
+
+    :param aids:
+    :param user_id: only revoke the keys of this user
+    :return: the ids of the keys that were revoked
+    """
+    if not aids:
+        return []
+
+    table = ApiKey.__table__
+    stmt = (
+        table.update()
+        .where(table.c.id.in_(set(aids)))
+        .where(table.c.revoked.is_(None) | (table.c.revoked == false()))
+        .values(revoked=True)
+        .returning(table.c.id)
+    )
+    if user_id is not None:
+        stmt = stmt.where(table.c.user_id == user_id)
+
+    revoked = [row.id for row in database.db.session.execute(stmt)]
+    if revoked:
+        database.db.session.execute(
+            TokenRevocation.__table__.insert(),
+            [dict(api_key_id=aid) for aid in revoked],
+        )
+    database.commit()
+
+    for aid in revoked:
+        revocation_index.forget(aid)
+    return revoked
 
 
 def get_all_api_keys():
@@ -59,6 +108,56 @@ def create(**kwargs):
     return api_key
 
 
+def missing_users(user_ids):
+    """
+    Returns the ids, among `user_ids`, of the users that don't exist. Looked
+    up on the primary with a single query.
+
+    :param user_ids:
+    :return: sorted list of ids
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return []
+
+    found = database.db.session.query(User.id).filter(User.id.in_(user_ids))
+    return sorted(user_ids - {user_id for (user_id,) in found})
+
+
+def create_many(specs):
+    """
+    Creates many API Keys with a single INSERT ... RETURNING and one commit.
+    The users must exist, see `missing_users`.
+
+    :param specs: dicts with the user_id, name and ttl of each key
+    :return: rows with the id, name, user_id and ttl of the new keys
+    """
+    if not specs:
+        return []
+
+    issued_at = int(datetime.utcnow().timestamp())
+    values = [
+        dict(
+            user_id=spec["user_id"],
+            name=spec.get("name"),
+            ttl=spec.get("ttl"),
+            issued_at=issued_at,
+            revoked=False,
+        )
+        for spec in specs
+    ]
+
+    table = ApiKey.__table__
+    stmt = (
+        table.insert()
+        .values(values)
+        .returning(table.c.id, table.c.name, table.c.user_id, table.c.ttl)
+    )
+    keys = database.db.session.execute(stmt).fetchall()
+    database.commit()
+    return keys
+
+
 def update(api_key, **kwargs):
     """
     Updates an api key.
@@ -68,8 +167,11 @@ def update(api_key, **kwargs):
     """
     for key, value in kwargs.items():
         setattr(api_key, key, value)
+    record_change(api_key.id)
 
-    return database.update(api_key)
+    api_key = database.update(api_key)
+    revocation_index.forget(api_key.id)
+    return api_key
 
 
 def render(args):
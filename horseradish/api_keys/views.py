@@ -7,21 +7,25 @@
 .. moduleauthor:: Eric Coan <kungfury@instructure.com>
 
 """
+import json
+
 from datetime import datetime
 
-from flask import Blueprint, g
+from flask import Blueprint, Response, current_app, g, stream_with_context
 from flask_restful import reqparse, Api
 
 from horseradish.api_keys import service
 from horseradish.auth.service import AuthenticatedResource, create_token
 from horseradish.auth.permissions import ApiKeyCreatorPermission
 
-from horseradish.common.schema import validate_schema
-from horseradish.common.utils import paginated_parser
+from horseradish.common.schema import validate_schema, wants_stream
+from horseradish.common.utils import paginated_parser, NDJSON_MIMETYPE
 
 from horseradish.api_keys.schemas import (
     api_key_input_schema,
     api_key_revoke_schema,
+    api_key_batch_input_schema,
+    api_key_batch_revoke_schema,
     api_key_output_schema,
     api_keys_output_schema,
     api_key_described_output_schema,
@@ -79,6 +83,11 @@ class ApiKeyList(AuthenticatedResource):
            :query sortDir: asc or desc
            :query page: int default is 1
            :query count: count number. default is 10
+           :query cursor: opaque keyset cursor, empty for the first page. Pages
+               by the sort column and id instead of by page number, and returns
+               nextCursor for the following page
+           :query total: exact, estimate, cached or none. default is exact, or none with a cursor
+           :query stream: write the items out as they are read, implied by Accept: application/x-ndjson
            :query user_id: a user to filter by.
            :query id: an access key to filter by.
            :reqheader Authorization: OAuth token to authenticate
@@ -87,8 +96,9 @@ class ApiKeyList(AuthenticatedResource):
         """
         parser = paginated_parser.copy()
         args = parser.parse_args()
+        args["stream"] = wants_stream(args)
         args["has_permission"] = ApiKeyCreatorPermission().can()
-        args["requesting_user_id"] = g.current_user.id
+        args["requesting_user_id"] = g.current_user_id
         return service.render(args)
 
     @validate_schema(api_key_input_schema, api_key_output_schema)
@@ -130,7 +140,7 @@ class ApiKeyList(AuthenticatedResource):
            :statuscode 403: unauthenticated
         """
         if not ApiKeyCreatorPermission().can():
-            if data["user"]["id"] != g.current_user.id:
+            if data["user"]["id"] != g.current_user_id:
                 return (
                     dict(
                         message="You are not authorized to create tokens for: {0}".format(
@@ -152,6 +162,185 @@ class ApiKeyList(AuthenticatedResource):
         )
 
 
+def ndjson_response(items):
+    """
+    Streams `items` back as newline delimited JSON, one object per line.
+
+    :param items: an iterable of dicts
+    :return:
+    """
+    return Response(
+        stream_with_context(json.dumps(item) + "\n" for item in items),
+        mimetype=NDJSON_MIMETYPE,
+    )
+
+
+def batch_too_large(size):
+    """
+    Returns an error response when a batch exceeds API_KEY_BATCH_MAX_SIZE.
+
+    :param size:
+    :return:
+    """
+    max_size = current_app.config.get("API_KEY_BATCH_MAX_SIZE", 1000)
+    if size > max_size:
+        return (
+            dict(message="At most {0} api keys per batch".format(max_size)),
+            400,
+        )
+
+
+class ApiKeyBatch(AuthenticatedResource):
+    """ Defines the 'keys/batch' endpoint """
+
+    def __init__(self):
+        super(ApiKeyBatch, self).__init__()
+
+    @validate_schema(api_key_batch_input_schema, None)
+    def post(self, data=None):
+        """
+        .. http:post:: /keys/batch
+
+           Creates many API Keys in one transaction, and streams back a JWT
+           for each of them, one per line. Each key needs a ttl, -1 for
+           forever; the user defaults to the current one.
+
+           **Example request**:
+
+           .. sourcecode:: http
+
+              POST /keys/batch HTTP/1.1
+              Host: example.com
+              Accept: application/x-ndjson
+
+              {
+                "keys": [
+                  {"name": "worker-1", "user": {"id": 1}, "ttl": -1},
+                  {"name": "worker-2", "user": {"id": 1}, "ttl": -1}
+                ]
+              }
+
+           **Example response**:
+
+           .. sourcecode:: http
+
+              HTTP/1.1 200 OK
+              Content-Type: application/x-ndjson
+
+              {"id": 1, "name": "worker-1", "userId": 1, "ttl": -1, "jwt": ""}
+              {"id": 2, "name": "worker-2", "userId": 1, "ttl": -1, "jwt": ""}
+
+           :reqheader Authorization: OAuth token to authenticate
+           :statuscode 200: no error
+           :statuscode 400: a key without a ttl or for an unknown user, or more than API_KEY_BATCH_MAX_SIZE keys
+           :statuscode 403: unauthenticated
+        """
+        error = batch_too_large(len(data["keys"]))
+        if error:
+            return error
+
+        if not ApiKeyCreatorPermission().can():
+            for spec in data["keys"]:
+                if spec["user"]["id"] != g.current_user_id:
+                    return (
+                        dict(
+                            message="You are not authorized to create tokens for: {0}".format(
+                                spec["user"].get("username", spec["user"]["id"])
+                            )
+                        ),
+                        403,
+                    )
+
+        missing = service.missing_users(spec["user"]["id"] for spec in data["keys"])
+        if missing:
+            return (
+                dict(
+                    message="Unknown user ids: {0}".format(
+                        ", ".join(str(user_id) for user_id in missing)
+                    )
+                ),
+                400,
+            )
+
+        keys = service.create_many(
+            [
+                dict(
+                    user_id=spec["user"]["id"],
+                    name=spec.get("name"),
+                    ttl=spec.get("ttl"),
+                )
+                for spec in data["keys"]
+            ]
+        )
+        return ndjson_response(
+            dict(
+                id=key.id,
+                name=key.name,
+                userId=key.user_id,
+                ttl=key.ttl,
+                jwt=create_token(key.user_id, key.id, key.ttl),
+            )
+            for key in keys
+        )
+
+
+class ApiKeyBatchRevoke(AuthenticatedResource):
+    """ Defines the 'keys/batch/revoke' endpoint """
+
+    def __init__(self):
+        super(ApiKeyBatchRevoke, self).__init__()
+
+    @validate_schema(api_key_batch_revoke_schema, None)
+    def post(self, data=None):
+        """
+        .. http:post:: /keys/batch/revoke
+
+           Revokes many api keys in one transaction, and streams back the
+           outcome for each of them, one per line. Keys that don't exist, are
+           already revoked or that you may not revoke are reported as not
+           revoked.
+
+           **Example request**:
+
+           .. sourcecode:: http
+
+              POST /keys/batch/revoke HTTP/1.1
+              Host: example.com
+              Accept: application/x-ndjson
+
+              {
+                "ids": [1, 2]
+              }
+
+           **Example response**:
+
+           .. sourcecode:: http
+
+              HTTP/1.1 200 OK
+              Content-Type: application/x-ndjson
+
+              {"id": 1, "revoked": true}
+              {"id": 2, "revoked": false}
+
+           :reqheader Authorization: OAuth token to authenticate
+           :statuscode 200: no error
+           :statuscode 400: more than API_KEY_BATCH_MAX_SIZE ids
+           :statuscode 403: unauthenticated
+        """
+        error = batch_too_large(len(data["ids"]))
+        if error:
+            return error
+
+        user_id = None
+        if not ApiKeyCreatorPermission().can():
+            user_id = g.current_user_id
+
+        revoked = set(service.revoke_many(data["ids"], user_id=user_id))
+        return ndjson_response(
+            dict(id=aid, revoked=aid in revoked) for aid in data["ids"]
+        )
+
+
 class ApiKeyUserList(AuthenticatedResource):
     """ Defines the 'keys' endpoint on the 'users' endpoint. """
 
@@ -199,6 +388,11 @@ class ApiKeyUserList(AuthenticatedResource):
            :query sortDir: asc or desc
            :query page: int default is 1
            :query count: count number. default is 10
+           :query cursor: opaque keyset cursor, empty for the first page. Pages
+               by the sort column and id instead of by page number, and returns
+               nextCursor for the following page
+           :query total: exact, estimate, cached or none. default is exact, or none with a cursor
+           :query stream: write the items out as they are read, implied by Accept: application/x-ndjson
            :query id: an access key to filter by.
            :reqheader Authorization: OAuth token to authenticate
            :statuscode 200: no error
@@ -206,8 +400,9 @@ class ApiKeyUserList(AuthenticatedResource):
         """
         parser = paginated_parser.copy()
         args = parser.parse_args()
+        args["stream"] = wants_stream(args)
         args["has_permission"] = ApiKeyCreatorPermission().can()
-        args["requesting_user_id"] = g.current_user.id
+        args["requesting_user_id"] = g.current_user_id
         args["user_id"] = user_id
         return service.render(args)
 
@@ -249,7 +444,7 @@ class ApiKeyUserList(AuthenticatedResource):
            :statuscode 403: unauthenticated
         """
         if not ApiKeyCreatorPermission().can():
-            if user_id != g.current_user.id:
+            if user_id != g.current_user_id:
                 return (
                     dict(
                         message="You are not authorized to create tokens for: {0}".format(
@@ -312,7 +507,7 @@ class ApiKeys(AuthenticatedResource):
         if access_key is None:
             return dict(message="This token does not exist!"), 404
 
-        if access_key.user_id != g.current_user.id:
+        if access_key.user_id != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to view this token!"), 403
 
@@ -359,7 +554,7 @@ class ApiKeys(AuthenticatedResource):
         if access_key is None:
             return dict(message="This token does not exist!"), 404
 
-        if access_key.user_id != g.current_user.id:
+        if access_key.user_id != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to update this token!"), 403
 
@@ -402,7 +597,7 @@ class ApiKeys(AuthenticatedResource):
         if access_key is None:
             return dict(message="This token does not exist!"), 404
 
-        if access_key.user_id != g.current_user.id:
+        if access_key.user_id != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to delete this token!"), 403
 
@@ -446,7 +641,7 @@ class UserApiKeys(AuthenticatedResource):
            :statuscode 200: no error
            :statuscode 403: unauthenticated
         """
-        if uid != g.current_user.id:
+        if uid != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to view this token!"), 403
 
@@ -497,7 +692,7 @@ class UserApiKeys(AuthenticatedResource):
            :statuscode 200: no error
            :statuscode 403: unauthenticated
         """
-        if uid != g.current_user.id:
+        if uid != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to view this token!"), 403
 
@@ -543,7 +738,7 @@ class UserApiKeys(AuthenticatedResource):
            :statuscode 200: no error
            :statuscode 403: unauthenticated
         """
-        if uid != g.current_user.id:
+        if uid != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to view this token!"), 403
 
@@ -603,7 +798,7 @@ class ApiKeysDescribed(AuthenticatedResource):
         if access_key is None:
             return dict(message="This token does not exist!"), 404
 
-        if access_key.user_id != g.current_user.id:
+        if access_key.user_id != g.current_user_id:
             if not ApiKeyCreatorPermission().can():
                 return dict(message="You are not authorized to view this token!"), 403
 
@@ -611,6 +806,10 @@ class ApiKeysDescribed(AuthenticatedResource):
 
 
 api.add_resource(ApiKeyList, "/keys", endpoint="api_keys")
+api.add_resource(ApiKeyBatch, "/keys/batch", endpoint="api_key_batch")
+api.add_resource(
+    ApiKeyBatchRevoke, "/keys/batch/revoke", endpoint="api_key_batch_revoke"
+)
 api.add_resource(ApiKeys, "/keys/<int:aid>", endpoint="api_key")
 api.add_resource(
     ApiKeysDescribed, "/keys/<int:aid>/described", endpoint="api_key_described"
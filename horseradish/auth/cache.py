@@ -0,0 +1,55 @@
+"""
+.. module: horseradish.auth.cache
+    :platform: Unix
+    :synopsis: Caches the outcome of token verification so that repeat requests
+    with the same token skip JWT decoding and the user/api key lookups.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+import hashlib
+
+from horseradish.common.cache import TTLCache
+
+# HORSERADISH_TOKEN_CACHE_SIZE / HORSERADISH_TOKEN_CACHE_TTL
+token_cache = TTLCache(maxsize=4096, ttl=60, config_prefix="HORSERADISH_TOKEN_CACHE")
+
+
+def token_digest(token):
+    """
+    Key under which a verified token is cached. We never keep the raw token
+    around.
+
+    :param token:
+    :return:
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def invalidate_user(user_id):
+    """
+    Drops every cached token of a user, e.g. after the user was deactivated
+    or its roles changed. Only affects this process, the other workers learn
+    about the change from :func:`horseradish.api_keys.revocations.record_change`.
+
+    :param user_id:
+    """
+    token_cache.discard(lambda entry: entry["user_id"] == int(user_id))
+
+
+def invalidate_api_key(aid):
+    """
+    Drops the cached tokens issued for an api key, e.g. after it was revoked.
+
+    :param aid:
+    """
+    token_cache.discard(lambda entry: entry["aid"] == int(aid))
+
+
+def invalidate_all():
+    """
+    Drops every cached token. Used when a change may affect the needs of
+    many users at once, like renaming or deleting a role. Only affects this
+    process, like :func:`invalidate_user`.
+    """
+    token_cache.clear()
@@ -0,0 +1,137 @@
+"""
+.. module: horseradish.auth.idp
+    :platform: Unix
+    :synopsis: A shared HTTP client for calls to identity providers.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+import os
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from horseradish.extensions import metrics
+
+
+class IdpClient(object):
+    """
+    Keeps one pooled :class:`requests.Session` per process for talking to
+    identity providers, so that logins reuse keep-alive connections instead of
+    paying a TCP and TLS handshake on every call.
+
+    Every request gets the ``IDP_CONNECT_TIMEOUT`` / ``IDP_READ_TIMEOUT``
+    timeouts unless it passes its own. Connection errors are retried up to
+    ``IDP_MAX_RETRIES`` times with exponential backoff (``IDP_RETRY_BACKOFF``).
+    Read errors and 502/503/504 responses are retried for idempotent methods
+    only, so an authorization code is never POSTed twice.
+
+    Each host gets a pool of ``IDP_POOL_MAXSIZE`` connections; ``IDP_POOL_SIZES``
+    maps url prefixes to a different size, e.g. for a busy token endpoint. The
+    duration of every call is sent as the ``idp.request`` timer, tagged with
+    the endpoint name.
+
+    :param app: The Flask application object. Defaults to None.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self.config = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes the application with the extension.
+
+        :param app: The Flask application object.
+        """
+        self.config = dict(
+            connect_timeout=app.config.get("IDP_CONNECT_TIMEOUT", 3.05),
+            read_timeout=app.config.get("IDP_READ_TIMEOUT", 10),
+            max_retries=app.config.get("IDP_MAX_RETRIES", 2),
+            retry_backoff=app.config.get("IDP_RETRY_BACKOFF", 0.3),
+            pool_connections=app.config.get("IDP_POOL_CONNECTIONS", 10),
+            pool_maxsize=app.config.get("IDP_POOL_MAXSIZE", 10),
+            pool_sizes=app.config.get("IDP_POOL_SIZES", {}),
+        )
+        with self._lock:
+            self._session = None
+
+    def _adapter(self, pool_maxsize):
+        retries = Retry(
+            total=self.config.get("max_retries", 2),
+            backoff_factor=self.config.get("retry_backoff", 0.3),
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        return HTTPAdapter(
+            pool_connections=self.config.get("pool_connections", 10),
+            pool_maxsize=pool_maxsize,
+            max_retries=retries,
+        )
+
+    @property
+    def session(self):
+        # connection pools must not be shared across a gunicorn fork
+        if self._session is not None and self._pid == os.getpid():
+            return self._session
+
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = self._adapter(self.config.get("pool_maxsize", 10))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                for prefix, size in self.config.get("pool_sizes", {}).items():
+                    session.mount(prefix, self._adapter(size))
+
+                self._session = session
+                self._pid = os.getpid()
+        return self._session
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        """
+        Sends a request to an identity provider.
+
+        :param method:
+        :param url:
+        :param endpoint: name under which the call is timed, defaults to the url
+        :param kwargs: passed on to :meth:`requests.Session.request`
+        :return:
+        """
+        kwargs.setdefault(
+            "timeout",
+            (
+                self.config.get("connect_timeout", 3.05),
+                self.config.get("read_timeout", 10),
+            ),
+        )
+
+        start = time.perf_counter()
+        status = "error"
+        try:
+            r = self.session.request(method, url, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            metrics.send(
+                "idp.request",
+                "timer",
+                1000 * (time.perf_counter() - start),
+                metric_tags={"endpoint": endpoint or url, "status": status},
+            )
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request("GET", url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request("POST", url, endpoint=endpoint, **kwargs)
+
+
+idp_client = IdpClient()
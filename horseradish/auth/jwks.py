@@ -0,0 +1,190 @@
+"""
+.. module: horseradish.auth.jwks
+    :platform: Unix
+    :synopsis: Caches the public keys published by identity providers (JWKS), so
+    that validating an id token does not require a round trip to the provider.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+import re
+import time
+import threading
+
+from email.utils import parsedate_to_datetime
+
+from flask import current_app
+
+from horseradish.auth.idp import idp_client
+from horseradish.auth.service import load_rsa_public_key
+from horseradish.exceptions import JwksUnavailable
+
+
+def cache_lifetime(headers, default):
+    """
+    Returns for how many seconds a response may be cached, based on its
+    Cache-Control or Expires header.
+
+    :param headers:
+    :param default: lifetime when the response doesn't say
+    :return:
+    """
+    cache_control = headers.get("Cache-Control", "")
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if match:
+        return int(match.group(1))
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return parsedate_to_datetime(expires).timestamp() - time.time()
+        except (TypeError, ValueError):
+            pass
+    return default
+
+
+class JwksCache(object):
+    """
+    Public keys per JWKS url, parsed and indexed by ``kid``.
+
+    Keys are kept for as long as the provider's cache headers allow, bounded by
+    ``JWKS_MIN_TTL`` and ``JWKS_MAX_TTL``. Once a document is past
+    ``JWKS_REFRESH_RATIO`` of its lifetime it is refreshed in the background
+    while the cached keys keep being served. A ``kid`` we have not seen triggers
+    an immediate refetch, to pick up rotated keys, but at most once every
+    ``JWKS_MIN_REFETCH_INTERVAL`` seconds per url.
+
+    When the keys have expired and the provider can't be reached, the expired
+    keys keep being served for ``JWKS_STALE_GRACE_PERIOD`` seconds, and the
+    provider is retried at most every ``JWKS_MIN_REFETCH_INTERVAL`` seconds.
+    Past that, or with no keys at all, `JwksUnavailable` is raised.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # url -> dict(keys, fetched_at, expires_at, refreshing)
+        self._documents = {}
+
+    def _config(self, key, default):
+        return current_app.config.get(key, default)
+
+    def fetch(self, jwks_url):
+        """
+        Downloads and parses a JWKS document.
+
+        :param jwks_url:
+        :return: (keys by kid, lifetime in seconds)
+        """
+        r = idp_client.get(jwks_url, endpoint="jwks")
+        r.raise_for_status()
+
+        keys = {}
+        for key in r.json()["keys"]:
+            if key.get("kty", "RSA") != "RSA" or "kid" not in key:
+                continue
+            keys[key["kid"]] = load_rsa_public_key(key["n"], key["e"])
+
+        return keys, cache_lifetime(r.headers, self._config("JWKS_TTL", 3600))
+
+    def _store(self, jwks_url, keys, lifetime):
+        lifetime = min(
+            max(lifetime, self._config("JWKS_MIN_TTL", 60)),
+            self._config("JWKS_MAX_TTL", 86400),
+        )
+        now = time.monotonic()
+        with self._lock:
+            self._documents[jwks_url] = dict(
+                keys=keys, fetched_at=now, expires_at=now + lifetime, refreshing=False
+            )
+
+    def refresh(self, jwks_url):
+        """
+        Fetches the document for a url and replaces the cached keys.
+
+        :param jwks_url:
+        :return: keys by kid
+        """
+        keys, lifetime = self.fetch(jwks_url)
+        self._store(jwks_url, keys, lifetime)
+        return keys
+
+    def _refresh_in_background(self, jwks_url):
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                try:
+                    self.refresh(jwks_url)
+                except Exception as e:
+                    app.logger.warning(
+                        "Unable to refresh JWKS from {0}: {1}".format(jwks_url, e)
+                    )
+                    with self._lock:
+                        document = self._documents.get(jwks_url)
+                        if document:
+                            document["refreshing"] = False
+
+        threading.Thread(target=run, name="horseradish-jwks", daemon=True).start()
+
+    def get_key(self, jwks_url, kid):
+        """
+        Returns the public key for `kid`, or None if the provider doesn't
+        publish it. Raises `JwksUnavailable` when the keys can't be fetched
+        and there are none to fall back on.
+
+        :param jwks_url:
+        :param kid:
+        :return:
+        """
+        now = time.monotonic()
+        with self._lock:
+            document = self._documents.get(jwks_url)
+            refresh_in_background = False
+            if document and now < document["expires_at"]:
+                lifetime = document["expires_at"] - document["fetched_at"]
+                refresh_at = document["fetched_at"] + lifetime * self._config(
+                    "JWKS_REFRESH_RATIO", 0.8
+                )
+                if now >= refresh_at and not document["refreshing"]:
+                    document["refreshing"] = refresh_in_background = True
+
+        if refresh_in_background:
+            self._refresh_in_background(jwks_url)
+
+        min_interval = self._config("JWKS_MIN_REFETCH_INTERVAL", 30)
+        if document and now < document["expires_at"]:
+            key = document["keys"].get(kid)
+            if key is not None:
+                return key
+
+            # an unknown kid usually means the provider rotated its keys
+            if now - document["fetched_at"] < min_interval:
+                return None
+
+        grace = self._config("JWKS_STALE_GRACE_PERIOD", 3600)
+        usable = document is not None and now < document["expires_at"] + grace
+        if usable and now < document.get("retry_at", 0):
+            # the provider failed a moment ago, don't wait on it again
+            return document["keys"].get(kid)
+
+        try:
+            return self.refresh(jwks_url).get(kid)
+        except Exception as e:
+            current_app.logger.warning(
+                "Unable to refresh JWKS from {0}: {1}".format(jwks_url, e)
+            )
+            if not usable:
+                raise JwksUnavailable(jwks_url) from e
+
+            with self._lock:
+                document["retry_at"] = now + min_interval
+            return document["keys"].get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+
+jwks_cache = JwksCache()
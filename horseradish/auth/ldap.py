@@ -5,6 +5,12 @@
     :license: Apache, see LICENSE for more details.
 .. moduleauthor:: Ian Stahnke <ian.stahnke@myob.com>
 """
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from functools import partial
+
 import ldap
 import ldap.filter
 
@@ -12,8 +18,168 @@ from flask import current_app
 
 from horseradish.users import service as user_service
 from horseradish.roles import service as role_service
+from horseradish.common.cache import TTLCache
+from horseradish.common.green import run_blocking
 from horseradish.common.utils import validate_conf, get_psuedo_random_string
 
+# user DN -> groups, LDAP_GROUP_CACHE_SIZE / LDAP_GROUP_CACHE_TTL
+group_cache = TTLCache(maxsize=10000, ttl=300, config_prefix="LDAP_GROUP_CACHE")
+
+
+def initialize(server, use_tls=False, cacert_file=None):
+    """
+    Builds an unbound ldap client with our connection options.
+
+    :param server:
+    :param use_tls:
+    :param cacert_file:
+    :return:
+    """
+    client = ldap.initialize(server)
+    client.set_option(ldap.OPT_REFERRALS, 0)
+    if use_tls:
+        ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+        client.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+        client.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
+        client.set_option(ldap.OPT_X_TLS_DEMAND, True)
+        client.set_option(ldap.OPT_DEBUG_LEVEL, 255)
+    if cacert_file:
+        client.set_option(ldap.OPT_X_TLS_CACERTFILE, cacert_file)
+    return client
+
+
+class LdapConnectionPool(object):
+    """
+    A bounded pool of connections bound as the service account
+    (``LDAP_SERVICE_BIND_DN`` / ``LDAP_SERVICE_BIND_PASSWORD``), used for
+    searches. User passwords are still checked with a short lived connection
+    of their own.
+
+    At most ``LDAP_POOL_SIZE`` connections are opened per process; a search
+    that finds them all busy waits up to ``LDAP_POOL_TIMEOUT`` seconds. The
+    pool is disabled when no service account is configured.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._pid = None
+        self.enabled = False
+        self.config = {}
+
+    def init_app(self, app):
+        """Initializes the application with the extension.
+
+        :param app: The Flask application object.
+        """
+        self.config = dict(
+            server=app.config.get("LDAP_BIND_URI"),
+            bind_dn=app.config.get("LDAP_SERVICE_BIND_DN"),
+            bind_password=app.config.get("LDAP_SERVICE_BIND_PASSWORD"),
+            use_tls=app.config.get("LDAP_USE_TLS", False),
+            cacert_file=app.config.get("LDAP_CACERT_FILE", None),
+            size=app.config.get("LDAP_POOL_SIZE", 5),
+            timeout=app.config.get("LDAP_POOL_TIMEOUT", 10),
+        )
+        self.enabled = bool(self.config["server"] and self.config["bind_dn"])
+        self.clear()
+
+    def clear(self):
+        """
+        Closes the idle connections and forgets about the busy ones.
+        """
+        with self._lock:
+            while True:
+                try:
+                    self._close(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+            self._created = 0
+            self._pid = os.getpid()
+
+    def _close(self, client):
+        try:
+            client.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _connect(self):
+        client = initialize(
+            self.config["server"], self.config["use_tls"], self.config["cacert_file"]
+        )
+        run_blocking(
+            client.simple_bind_s, self.config["bind_dn"], self.config["bind_password"]
+        )
+        return client
+
+    def _acquire(self):
+        # connections must not be shared across a gunicorn fork
+        if self._pid != os.getpid():
+            self.clear()
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.config["size"]
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.config["timeout"])
+        except queue.Empty:
+            raise Exception("ldap connection pool exhausted")
+
+    def _discard(self, client):
+        self._close(client)
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a service bound connection. A connection that failed with
+        SERVER_DOWN is closed instead of being returned to the pool.
+        """
+        client = self._acquire()
+        try:
+            yield client
+        except ldap.SERVER_DOWN:
+            self._discard(client)
+            raise
+        except Exception:
+            self._idle.put(client)
+            raise
+        else:
+            self._idle.put(client)
+
+    def search_s(self, *args, **kwargs):
+        """
+        Runs a synchronous search on a pooled connection. A stale connection
+        is replaced once.
+        """
+        for attempt in range(2):
+            try:
+                with self.connection() as client:
+                    return run_blocking(client.search_s, *args, **kwargs)
+            except ldap.SERVER_DOWN:
+                if attempt:
+                    raise
+
+
+ldap_pool = LdapConnectionPool()
+
 
 class LdapPrincipal:
     """
@@ -103,46 +269,31 @@ class LdapPrincipal:
             if self.ldap_required_group not in self.ldap_groups:
                 return None
 
-        roles = set()
+        group_roles = [
+            role_name
+            for ldap_group_name, role_name in (self.ldap_groups_to_roles or {}).items()
+            if ldap_group_name in self.ldap_groups
+        ]
+        names = list(group_roles)
         if self.ldap_default_role:
-            role = role_service.get_by_name(self.ldap_default_role)
-            if role:
-                if not role.third_party:
-                    role = role_service.set_third_party(
-                        role.id, third_party_status=True
-                    )
-                roles.add(role)
+            names.append(self.ldap_default_role)
 
-        # update their 'roles'
-        role = role_service.get_by_name(self.ldap_principal)
-        if not role:
-            description = "auto generated role based on owner: {0}".format(
-                self.ldap_principal
-            )
-            role = role_service.create(
-                self.ldap_principal, description=description, third_party=True
-            )
-        if not role.third_party:
-            role = role_service.set_third_party(role.id, third_party_status=True)
-        roles.add(role)
-        if not self.ldap_groups_to_roles:
-            return roles
-
-        for ldap_group_name, role_name in self.ldap_groups_to_roles.items():
-            role = role_service.get_by_name(role_name)
-            if role:
-                if ldap_group_name in self.ldap_groups:
-                    current_app.logger.debug(
-                        "assigning role {0} to ldap user {1}".format(
-                            self.ldap_principal, role
-                        )
+        # update their 'roles', all in one go
+        description = "auto generated role based on owner: {0}".format(
+            self.ldap_principal
+        )
+        resolved = role_service.resolve(
+            names, create={self.ldap_principal: description}
+        )
+
+        for role_name in group_roles:
+            if role_name in resolved:
+                current_app.logger.debug(
+                    "assigning role {0} to ldap user {1}".format(
+                        self.ldap_principal, resolved[role_name]
                     )
-                    if not role.third_party:
-                        role = role_service.set_third_party(
-                            role.id, third_party_status=True
-                        )
-                    roles.add(role)
-        return roles
+                )
+        return set(resolved.values())
 
     def authenticate(self):
         """
@@ -172,37 +323,61 @@ class LdapPrincipal:
         )
 
         ldap_filter = f"uid={filtered_username}"
+        ldap_uid = f"uid={filtered_username},{self.ldap_base_dn}"
         # query ldap for auth
         try:
             # build a client
             if not self.ldap_client:
-                self.ldap_client = ldap.initialize(self.ldap_server)
-            # perform a synchronous bind
-            self.ldap_client.set_option(ldap.OPT_REFERRALS, 0)
-            if self.ldap_use_tls:
-                ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-                self.ldap_client.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
-                self.ldap_client.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
-                self.ldap_client.set_option(ldap.OPT_X_TLS_DEMAND, True)
-                self.ldap_client.set_option(ldap.OPT_DEBUG_LEVEL, 255)
-            if self.ldap_cacert_file:
-                self.ldap_client.set_option(
-                    ldap.OPT_X_TLS_CACERTFILE, self.ldap_cacert_file
+                self.ldap_client = initialize(
+                    self.ldap_server, self.ldap_use_tls, self.ldap_cacert_file
                 )
-
-            ldap_uid = f"uid={filtered_username},{self.ldap_base_dn}"
-            self.ldap_client.simple_bind_s(ldap_uid, self.ldap_password)
+            # perform a synchronous bind
+            run_blocking(
+                self.ldap_client.simple_bind_s, ldap_uid, self.ldap_password
+            )
         except ldap.INVALID_CREDENTIALS:
             self.ldap_client.unbind()
+            self.ldap_client = None
             raise Exception("The supplied ldap credentials are invalid")
         except ldap.SERVER_DOWN:
             raise Exception("ldap server unavailable")
         except ldap.LDAPError as e:
             raise Exception("ldap error: {0}".format(e))
 
+        try:
+            self.ldap_groups = group_cache.get(ldap_uid)
+            if self.ldap_groups is None:
+                if ldap_pool.enabled:
+                    # the password checked out, searches go through the pool
+                    self.ldap_client.unbind()
+                    self.ldap_client = None
+                    self.ldap_groups = self._search_groups(ldap_pool, ldap_filter)
+                else:
+                    self.ldap_groups = self._search_groups(
+                        self.ldap_client, ldap_filter
+                    )
+                group_cache.set(ldap_uid, self.ldap_groups)
+        except ldap.SERVER_DOWN:
+            raise Exception("ldap server unavailable")
+        except ldap.LDAPError as e:
+            raise Exception("ldap error: {0}".format(e))
+        finally:
+            if self.ldap_client:
+                self.ldap_client.unbind()
+                self.ldap_client = None
+
+    def _search_groups(self, client, ldap_filter):
+        """
+        list groups for a user, with either a bound client or the pool.
+        """
+        if isinstance(client, LdapConnectionPool):
+            search = client.search_s
+        else:
+            search = partial(run_blocking, client.search_s)
+
         if self.ldap_is_active_directory:
             # Lookup user DN, needed to search for group membership
-            userdn = self.ldap_client.search_s(
+            userdn = search(
                 self.ldap_base_dn,
                 ldap.SCOPE_SUBTREE,
                 ldap_filter,
@@ -215,24 +390,23 @@ class LdapPrincipal:
                     userdn
                 )
             )
-            lgroups = self.ldap_client.search_s(
+            lgroups = search(
                 self.ldap_base_dn, ldap.SCOPE_SUBTREE, groupfilter, ["cn"]
             )
 
             # Create a list of group CN's from the result
-            self.ldap_groups = []
+            groups = []
             for group in lgroups:
                 (dn, values) = group
-                self.ldap_groups.append(values["cn"][0].decode("ascii"))
-        else:
-            lgroups = self.ldap_client.search_s(
-                self.ldap_base_dn, ldap.SCOPE_SUBTREE, ldap_filter, self.ldap_attrs
-            )[0][1]["memberOf"]
-            # lgroups is a list of utf-8 encoded strings
-            # convert to a single string of groups to allow matching
-            self.ldap_groups = b"".join(lgroups).decode("ascii")
-
-        self.ldap_client.unbind()
+                groups.append(values["cn"][0].decode("ascii"))
+            return groups
+
+        lgroups = search(
+            self.ldap_base_dn, ldap.SCOPE_SUBTREE, ldap_filter, self.ldap_attrs
+        )[0][1]["memberOf"]
+        # lgroups is a list of utf-8 encoded strings
+        # convert to a single string of groups to allow matching
+        return b"".join(lgroups).decode("ascii")
 
     def _ldap_validate_conf(self):
         """
@@ -0,0 +1,146 @@
+"""
+.. module: horseradish.auth.passwords
+    :platform: Unix
+    :synopsis: Runs password hashing and verification off the request thread,
+    on a small bounded pool.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import TooManyRequests
+
+from horseradish.extensions import bcrypt, metrics
+from horseradish.common.green import is_green
+
+
+class PasswordHashingBusy(TooManyRequests):
+    description = "Too many password checks in progress, try again shortly."
+
+    def get_headers(self, environ=None):
+        headers = super(PasswordHashingBusy, self).get_headers(environ)
+        headers.append(("Retry-After", "1"))
+        return headers
+
+
+def hash_rounds(pw_hash):
+    """
+    Returns the bcrypt cost a hash was made with, or None if it isn't a
+    bcrypt hash.
+
+    :param pw_hash: e.g. $2b$12$...
+    :return:
+    """
+    try:
+        return int(pw_hash.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt on ``PASSWORD_HASH_WORKERS`` threads (bcrypt releases the GIL
+    while it works), so a burst of logins can only keep that many cores busy
+    and the other endpoints keep being served.
+
+    At most ``PASSWORD_HASH_QUEUE_SIZE`` hashes may be running or waiting for
+    a worker. Past that, :class:`PasswordHashingBusy` is raised and the request
+    fails with a 429 instead of queueing up. Both limits are per process, and
+    only matter when a process serves concurrent requests (gthread or gevent
+    workers, see docs/production.md). A sync worker hashes one password at a
+    time and never sheds load. The cost factor is Flask-Bcrypt's
+    ``BCRYPT_LOG_ROUNDS``; hashes made with another cost are reported by
+    :meth:`needs_rehash` so they can be upgraded at the next login.
+
+    :param app: The Flask application object. Defaults to None.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = threading.BoundedSemaphore(16)
+        self.workers = 2
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Initializes the application with the extension.
+
+        :param app: The Flask application object.
+        """
+        self.workers = app.config.get("PASSWORD_HASH_WORKERS", 2)
+        self._slots = threading.BoundedSemaphore(
+            app.config.get("PASSWORD_HASH_QUEUE_SIZE", 16)
+        )
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @property
+    def executor(self):
+        # threads don't survive a gunicorn fork
+        if self._executor is not None and self._pid == os.getpid():
+            return self._executor
+
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                executor_class = ThreadPoolExecutor
+                if is_green():
+                    # patched threads are greenlets, bcrypt needs native ones
+                    from gevent.threadpool import ThreadPoolExecutor as executor_class
+
+                self._executor = executor_class(
+                    max_workers=self.workers, thread_name_prefix="horseradish-bcrypt"
+                )
+                self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.send("password_hash.rejected", "counter", 1)
+            raise PasswordHashingBusy()
+
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def check(self, pw_hash, password):
+        """
+        Checks a password against its stored hash.
+
+        :param pw_hash:
+        :param password:
+        :return:
+        """
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    def hash(self, password):
+        """
+        Hashes a password with the configured cost.
+
+        :param password:
+        :return: the hash, as a string
+        """
+        return self._run(bcrypt.generate_password_hash, password).decode("utf-8")
+
+    def needs_rehash(self, pw_hash):
+        """
+        Tells whether a hash was made with a different cost than the
+        configured one.
+
+        :param pw_hash:
+        :return:
+        """
+        return hash_rounds(pw_hash) != current_app.config.get("BCRYPT_LOG_ROUNDS", 12)
+
+
+password_hasher = PasswordHasher()
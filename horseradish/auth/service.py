@@ -10,12 +10,14 @@
 """
 import jwt
 import json
+import time
 import binascii
 
 from functools import wraps
 from datetime import datetime, timedelta
 
 from flask import g, current_app, jsonify, request
+from werkzeug.local import LocalProxy
 
 from flask_restful import Resource
 from flask_principal import identity_loaded, RoleNeed, UserNeed
@@ -26,10 +28,12 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
 
+from horseradish import database
 from horseradish.users import service as user_service
 from horseradish.roles import service as role_service
-from horseradish.api_keys import service as api_key_service
+from horseradish.api_keys.revocations import revocation_index
 from horseradish.auth.permissions import RoleMemberNeed
+from horseradish.auth.cache import token_cache, token_digest
 
 
 def idp_groups_to_roles(profile):
@@ -46,10 +50,16 @@ def idp_groups_to_roles(profile):
     if not idp_groups_to_roles or not idp_groups_key or idp_groups_key not in profile:
         return
 
-    for idp_group_name, role_name in idp_groups_to_roles.items():
-        role = role_service.get_by_name(role_name)
+    groups = {
+        idp_group_name: role_name
+        for idp_group_name, role_name in idp_groups_to_roles.items()
+        if idp_group_name in profile[idp_groups_key]
+    }
+    roles = role_service.resolve(groups.values())
 
-        if not role or idp_group_name not in profile[idp_groups_key]:
+    for idp_group_name, role_name in groups.items():
+        role = roles.get(role_name)
+        if not role:
             continue
 
         current_app.logger.info(
@@ -57,24 +67,32 @@ def idp_groups_to_roles(profile):
                 role, profile["email"], idp_group_name
             )
         )
-
-        if not role.third_party:
-            role = role_service.set_third_party(role.id, third_party_status=True)
         yield role
 
 
-def get_rsa_public_key(n, e):
+def load_rsa_public_key(n, e):
     """
-    Retrieve an RSA public key based on a module and exponent as provided by the JWKS format.
+    Load an RSA public key based on a module and exponent as provided by the JWKS format.
 
     :param n:
     :param e:
-    :return: a RSA Public Key in PEM format
+    :return: a RSA Public Key object, usable by jwt.decode as is
     """
     n = int(binascii.hexlify(jwt.utils.base64url_decode(bytes(n, "utf-8"))), 16)
     e = int(binascii.hexlify(jwt.utils.base64url_decode(bytes(e, "utf-8"))), 16)
 
-    pub = RSAPublicNumbers(e, n).public_key(default_backend())
+    return RSAPublicNumbers(e, n).public_key(default_backend())
+
+
+def get_rsa_public_key(n, e):
+    """
+    Retrieve an RSA public key based on a module and exponent as provided by the JWKS format.
+
+    :param n:
+    :param e:
+    :return: a RSA Public Key in PEM format
+    """
+    pub = load_rsa_public_key(n, e)
     return pub.public_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo,
@@ -112,10 +130,119 @@ def create_token(user, aid=None, ttl=None):
     return token.decode("unicode_escape")
 
 
+def _verify_token(token):
+    """
+    Decodes the JWT and looks up the api key and user it was issued for. The
+    outcome is returned as a cache entry, or as an error response.
+
+    :param token:
+    :return: (entry, user, error)
+    """
+    try:
+        payload = jwt.decode(token, current_app.config["HORSERADISH_TOKEN_SECRET"])
+    except jwt.DecodeError:
+        return None, None, (dict(message="Token is invalid"), 403)
+    except jwt.ExpiredSignatureError:
+        return None, None, (dict(message="Token has expired"), 403)
+    except jwt.InvalidTokenError:
+        return None, None, (dict(message="Token is invalid"), 403)
+
+    key_expires_at = None
+
+    if "aid" in payload:
+        revoked, issued_at, ttl = revocation_index.get(payload["aid"])
+        if revoked:
+            return None, None, (dict(message="Token has been revoked"), 403)
+        if ttl != -1:
+            current_time = datetime.utcnow()
+            expired_time = datetime.fromtimestamp(issued_at + ttl)
+            if current_time >= expired_time:
+                return None, None, (dict(message="Token has expired"), 403)
+            key_expires_at = issued_at + ttl
+
+    # the entry outlives the request, it must not be built from a lagging
+    # replica right after the user was deactivated or lost a role
+    with database.primary():
+        user = user_service.get(payload["sub"])
+
+        if not user:
+            return None, None, (dict(message="You are not logged in"), 403)
+
+        entry = dict(
+            user_id=user.id,
+            aid=payload.get("aid"),
+            active=user.active,
+            needs=frozenset(get_identity_needs(user)),
+            exp=payload.get("exp"),
+            key_expires_at=key_expires_at,
+        )
+    return entry, user, None
+
+
+def _seconds_left(entry):
+    """
+    Seconds until a verified token expires, or None if it never does.
+
+    :param entry:
+    :return:
+    """
+    left = []
+    if entry["exp"] is not None:
+        left.append(entry["exp"] - time.time())
+    if entry["key_expires_at"] is not None:
+        # api keys are issued with `datetime.utcnow().timestamp()`
+        left.append(entry["key_expires_at"] - datetime.utcnow().timestamp())
+    return min(left) if left else None
+
+
+def load_identity(user_id):
+    """
+    Returns the user with `user_id`, loading it at most once per request.
+    login_required, Flask-Principal and the views all go through here, so
+    they share a single copy of the user.
+
+    :param user_id:
+    :return:
+    """
+    user = g.get("_current_user")
+    if user is None or user.id != user_id:
+        user = user_service.get(user_id)
+        g._current_user = user
+    return user
+
+
+def set_current_user(user):
+    """
+    Makes an already loaded user the identity of the current request, e.g.
+    right after a login, so that Flask-Principal doesn't load it again.
+
+    :param user:
+    """
+    g._current_user = user
+    g.current_user = user
+    g.current_user_id = user.id
+
+
+def _load_current_user():
+    """
+    Loads the user of a request that was authenticated from the token cache,
+    the first time a view actually needs it.
+    """
+    return load_identity(g.current_user_id)
+
+
 def login_required(f):
     """
     Validates the JWT and ensures that is has not expired and the user is still active.
 
+    Verified tokens are kept in :data:`horseradish.auth.cache.token_cache`, so a
+    token seen recently costs neither a JWT decode nor a database round trip.
+    The cached entry is dropped when its api key is revoked, its user is
+    updated or a role changes. Api keys are checked against
+    :data:`horseradish.api_keys.revocations.revocation_index`, which learns
+    about the changes made by other workers within
+    ``API_KEY_REVOCATION_POLL_INTERVAL`` seconds.
+
     :param f:
     :return:
     """
@@ -132,40 +259,38 @@ def login_required(f):
         except Exception as e:
             return dict(message="Token is invalid"), 403
 
-        try:
-            payload = jwt.decode(token, current_app.config["HORSERADISH_TOKEN_SECRET"])
-        except jwt.DecodeError:
-            return dict(message="Token is invalid"), 403
-        except jwt.ExpiredSignatureError:
-            return dict(message="Token has expired"), 403
-        except jwt.InvalidTokenError:
-            return dict(message="Token is invalid"), 403
+        # picks up api keys revoked through other workers
+        revocation_index.sync()
 
-        if "aid" in payload:
-            access_key = api_key_service.get(payload["aid"])
-            if access_key.revoked:
-                return dict(message="Token has been revoked"), 403
-            if access_key.ttl != -1:
-                current_time = datetime.utcnow()
-                expired_time = datetime.fromtimestamp(
-                    access_key.issued_at + access_key.ttl
-                )
-                if current_time >= expired_time:
-                    return dict(message="Token has expired"), 403
+        digest = token_digest(token)
+        entry = token_cache.get(digest)
 
-        user = user_service.get(payload["sub"])
+        if entry is not None:
+            seconds_left = _seconds_left(entry)
+            if seconds_left is not None and seconds_left <= 0:
+                token_cache.pop(digest)
+                return dict(message="Token has expired"), 403
 
-        if not user.active:
-            return dict(message="User is not currently active"), 403
+        if entry is None:
+            entry, user, error = _verify_token(token)
+            if error:
+                return error
 
-        g.current_user = user
+            token_cache.set(digest, entry, ttl=_seconds_left(entry))
 
-        if not g.current_user:
-            return dict(message="You are not logged in"), 403
+            g._current_user = g.current_user = user
+        else:
+            g.current_user = LocalProxy(_load_current_user)
+
+        if not entry["active"]:
+            return dict(message="User is not currently active"), 403
+
+        g.current_user_id = entry["user_id"]
+        g.identity_needs = entry["needs"]
 
         # Tell Flask-Principal the identity changed
         identity_changed.send(
-            current_app._get_current_object(), identity=Identity(g.current_user.id)
+            current_app._get_current_object(), identity=Identity(entry["user_id"])
         )
 
         return f(*args, **kwargs)
@@ -194,31 +319,55 @@ def fetch_token_header(token):
         raise jwt.DecodeError("Invalid header padding")
 
 
-@identity_loaded.connect
-def on_identity_loaded(sender, identity):
+def get_identity_needs(user):
     """
-    Sets the identity of a given option, assigns additional permissions based on
-    the role that the user is a part of.
+    Returns the needs a user provides, based on the roles that the user is a
+    part of.
 
-    :param sender:
-    :param identity:
+    :param user:
+    :return:
     """
-    # load the user
-    user = user_service.get(identity.id)
-
     # add the UserNeed to the identity
-    identity.provides.add(UserNeed(identity.id))
+    needs = {UserNeed(user.id)}
 
     # identity with the roles that the user provides
     if hasattr(user, "roles"):
         for role in user.roles:
-            identity.provides.add(RoleNeed(role.name))
-            identity.provides.add(RoleMemberNeed(role.id))
+            needs.add(RoleNeed(role.name))
+            needs.add(RoleMemberNeed(role.id))
 
     # apply ownership for authorities
     # if hasattr(user, "authorities"):
     #    for authority in user.authorities:
-    #        identity.provides.add(AuthorityCreatorNeed(authority.id))
+    #        needs.add(AuthorityCreatorNeed(authority.id))
+
+    return needs
+
+
+@identity_loaded.connect
+def on_identity_loaded(sender, identity):
+    """
+    Sets the identity of a given option, assigns additional permissions based on
+    the role that the user is a part of.
+
+    :param sender:
+    :param identity:
+    """
+    # login_required already knows the needs, either from the token cache or
+    # from the user it just loaded
+    needs = g.pop("identity_needs", None)
+
+    if needs is not None and g.get("current_user_id") == identity.id:
+        identity.provides.update(needs)
+        g.user = g.current_user
+        return
+
+    # the user, unless this request already loaded it
+    user = load_identity(identity.id)
+
+    identity.provides.add(UserNeed(identity.id))
+    if user:
+        identity.provides.update(get_identity_needs(user))
 
     g.user = user
 
@@ -7,7 +7,6 @@
 """
 import jwt
 import base64
-import requests
 
 from flask import Blueprint, current_app
 
@@ -23,8 +22,11 @@ from horseradish.roles import service as role_service
 from horseradish.auth.service import (
     create_token,
     fetch_token_header,
-    get_rsa_public_key,
+    set_current_user,
 )
+from horseradish.auth.idp import idp_client
+from horseradish.auth.jwks import jwks_cache
+from horseradish.exceptions import JwksUnavailable
 from horseradish.auth import ldap
 
 
@@ -65,14 +67,16 @@ def exchange_for_access_token(
         "authorization": "basic {0}".format(basic.decode("utf-8")),
     }
 
-    # exchange authorization code for access token.
-    r = requests.post(
-        access_token_url, headers=headers, params=params, verify=verify_cert
+    # exchange authorization code for access token. the parameters go in the
+    # form encoded body (RFC 6749 4.1.3), codes are single use so this is
+    # never retried once the provider has seen it
+    r = idp_client.post(
+        access_token_url,
+        endpoint="token",
+        headers=headers,
+        data=params,
+        verify=verify_cert,
     )
-    if r.status_code == 400:
-        r = requests.post(
-            access_token_url, headers=headers, data=params, verify=verify_cert
-        )
     id_token = r.json()["id_token"]
     access_token = r.json()["access_token"]
 
@@ -91,21 +95,19 @@ def validate_id_token(id_token, client_id, jwks_url):
     # fetch token public key
     header_data = fetch_token_header(id_token)
 
-    # retrieve the key material as specified by the token header
-    r = requests.get(jwks_url)
-    for key in r.json()["keys"]:
-        if key["kid"] == header_data["kid"]:
-            secret = get_rsa_public_key(key["n"], key["e"])
-            algo = header_data["alg"]
-            break
-    else:
+    # retrieve the key material as specified by the token header, the
+    # provider's keys are cached by kid
+    try:
+        secret = jwks_cache.get_key(jwks_url, header_data.get("kid"))
+    except JwksUnavailable:
+        return dict(message="Unable to retrieve the provider's keys"), 503
+    if secret is None:
         return dict(message="Key not found"), 401
+    algo = header_data["alg"]
 
     # validate your token based on the key it was signed with
     try:
-        jwt.decode(
-            id_token, secret.decode("utf-8"), algorithms=[algo], audience=client_id
-        )
+        jwt.decode(id_token, secret, algorithms=[algo], audience=client_id)
     except jwt.DecodeError:
         return dict(message="Token is invalid"), 401
     except jwt.ExpiredSignatureError:
@@ -130,10 +132,14 @@ def retrieve_user(user_api_url, access_token):
         headers = {"Authorization": f"Bearer {access_token}"}
 
     # retrieve information about the current user.
-    r = requests.get(user_api_url, params=user_params, headers=headers)
+    r = idp_client.get(
+        user_api_url, endpoint="userinfo", params=user_params, headers=headers
+    )
     # Some IDPs, like "Keycloak", require a POST instead of a GET
     if r.status_code == 400:
-        r = requests.post(user_api_url, data=user_params, headers=headers)
+        r = idp_client.post(
+            user_api_url, endpoint="userinfo", data=user_params, headers=headers
+        )
 
     profile = r.json()
 
@@ -147,54 +153,30 @@ def create_user_roles(profile):
     :param profile:
     :return:
     """
-    roles = []
+    create = {}
+    google_group_description = (
+        "This is a google group based role created by Horseradish"
+    )
 
     # update their google 'roles'
     if "googleGroups" in profile:
         for group in profile["googleGroups"]:
-            role = role_service.get_by_name(group)
-            if not role:
-                role = role_service.create(
-                    group,
-                    description="This is a google group based role created by Horseradish",
-                    third_party=True,
-                )
-            if not role.third_party:
-                role = role_service.set_third_party(role.id, third_party_status=True)
-            roles.append(role)
+            create[group] = google_group_description
     else:
         current_app.logger.warning(
             "'googleGroups' not sent by identity provider, no specific roles will assigned to the user."
         )
 
-    role = role_service.get_by_name(profile["email"])
-
-    if not role:
-        role = role_service.create(
-            profile["email"],
-            description="This is a user specific role",
-            third_party=True,
-        )
-    if not role.third_party:
-        role = role_service.set_third_party(role.id, third_party_status=True)
-
-    roles.append(role)
+    create.setdefault(profile["email"], "This is a user specific role")
 
     # every user is an operator (tied to a default role)
-    if current_app.config.get("HORSERADISH_DEFAULT_ROLE"):
-        default = role_service.get_by_name(
-            current_app.config["HORSERADISH_DEFAULT_ROLE"]
-        )
-        if not default:
-            default = role_service.create(
-                current_app.config["HORSERADISH_DEFAULT_ROLE"],
-                description="This is the default Horseradish role.",
-            )
-        if not default.third_party:
-            role_service.set_third_party(default.id, third_party_status=True)
-        roles.append(default)
+    default_role = current_app.config.get("HORSERADISH_DEFAULT_ROLE")
+    if default_role:
+        create.setdefault(default_role, "This is the default Horseradish role.")
 
-    return roles
+    # look up, create and flag all of them at once
+    roles = role_service.resolve([], create=create)
+    return [roles[name] for name in create]
 
 
 def update_user(user, profile, roles):
@@ -289,6 +271,7 @@ class Login(Resource):
            :arg username: username
            :arg password: password
            :statuscode 401: invalid credentials
+           :statuscode 429: too many password checks in progress
            :statuscode 200: no error
         """
         self.reqparse.add_argument("username", type=str, required=True, location="json")
@@ -303,7 +286,10 @@ class Login(Resource):
 
         # default to local authentication
         if user and user.check_password(args["password"]) and user.active:
+            user_service.rehash_password(user, args["password"])
+
             # Tell Flask-Principal the identity changed
+            set_current_user(user)
             identity_changed.send(
                 current_app._get_current_object(), identity=Identity(user.id)
             )
@@ -320,6 +306,7 @@ class Login(Resource):
                 user = ldap_principal.authenticate()
                 if user and user.active:
                     # Tell Flask-Principal the identity changed
+                    set_current_user(user)
                     identity_changed.send(
                         current_app._get_current_object(), identity=Identity(user.id)
                     )
@@ -401,6 +388,7 @@ class Ping(Resource):
             return dict(message="The supplied credentials are invalid"), 403
 
         # Tell Flask-Principal the identity changed
+        set_current_user(user)
         identity_changed.send(
             current_app._get_current_object(), identity=Identity(user.id)
         )
@@ -460,6 +448,7 @@ class OAuth2(Resource):
             return dict(message="The supplied credentials are invalid"), 403
 
         # Tell Flask-Principal the identity changed
+        set_current_user(user)
         identity_changed.send(
             current_app._get_current_object(), identity=Identity(user.id)
         )
@@ -497,13 +486,13 @@ class Google(Resource):
             "client_secret": current_app.config.get("GOOGLE_SECRET"),
         }
 
-        r = requests.post(access_token_url, data=payload)
+        r = idp_client.post(access_token_url, endpoint="google_token", data=payload)
         token = r.json()
 
         # Step 2. Retrieve information about the current user
         headers = {"Authorization": "Bearer {0}".format(token["access_token"])}
 
-        r = requests.get(people_api_url, headers=headers)
+        r = idp_client.get(people_api_url, endpoint="google_people", headers=headers)
         profile = r.json()
 
         user = user_service.get_by_email(profile["email"])
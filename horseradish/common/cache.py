@@ -0,0 +1,128 @@
+"""
+.. module: horseradish.common.cache
+    :platform: Unix
+    :synopsis: Small in-process caches shared by the service layer.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A thread-safe, bounded mapping. Entries expire ``ttl`` seconds after they
+    were set and the least recently used entry is evicted once ``maxsize`` is
+    reached.
+
+    When ``config_prefix`` is given, ``init_app`` reads ``<prefix>_SIZE`` and
+    ``<prefix>_TTL`` from the application config. A size of 0 disables the
+    cache.
+
+    :param maxsize: maximum number of entries
+    :param ttl: default lifetime of an entry, in seconds
+    :param config_prefix: application config prefix
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, config_prefix=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.config_prefix = config_prefix
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        """Reads the cache size and ttl from the application config.
+
+        :param app: The Flask application object.
+        """
+        if self.config_prefix:
+            self.maxsize = int(
+                app.config.get("{0}_SIZE".format(self.config_prefix), self.maxsize)
+            )
+            self.ttl = float(
+                app.config.get("{0}_TTL".format(self.config_prefix), self.ttl)
+            )
+        self.clear()
+
+    def get(self, key, default=None):
+        """
+        Returns the live value for `key`, marking it as recently used.
+
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores `value` under `key`. `ttl` overrides the default lifetime, but
+        never extends it.
+
+        :param key:
+        :param value:
+        :param ttl:
+        """
+        if self.maxsize <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Removes `key` and returns its value, expired or not.
+
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def discard(self, predicate):
+        """
+        Removes every entry whose value satisfies `predicate`.
+
+        :param predicate: callable taking a cached value
+        :return: the number of removed entries
+        """
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if predicate(v)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,62 @@
+"""
+.. module: horseradish.common.green
+    :platform: Unix
+    :synopsis: Helpers to run under gevent workers, where one process serves
+    many concurrent requests as greenlets.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+
+
+def is_green():
+    """
+    Tells whether the process was monkey patched by gevent, e.g. because it is
+    a gunicorn gevent worker. gevent is optional.
+
+    :return:
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def patch_drivers(app):
+    """
+    Makes the drivers that block in C cooperative when running under gevent:
+    psycopg2 waits for the database through the hub (needs psycogreen), and
+    the native thread pool used by `run_blocking` is sized to
+    HORSERADISH_BLOCKING_POOL_SIZE.
+
+    :param app: The Flask application object.
+    """
+    if not is_green():
+        return
+
+    import gevent
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+    gevent.get_hub().threadpool.maxsize = app.config.get(
+        "HORSERADISH_BLOCKING_POOL_SIZE", 20
+    )
+
+
+def run_blocking(fn, *args, **kwargs):
+    """
+    Calls `fn`. Under gevent, the call is made on a native thread, so that a
+    library blocking in C (python-ldap) doesn't stall every other greenlet of
+    the process.
+
+    :param fn:
+    :return: whatever `fn` returns
+    """
+    if not is_green():
+        return fn(*args, **kwargs)
+
+    import gevent
+
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
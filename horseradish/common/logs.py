@@ -0,0 +1,120 @@
+"""
+.. module: horseradish.common.logs
+    :platform: Unix
+    :synopsis: Hands log records to a single writer thread, so that logging
+    never makes a request wait on formatting or disk I/O.
+    :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
+    :license: Apache, see LICENSE for more details.
+
+.. moduleauthor:: Sam Havron <havron@hey.com>
+"""
+import os
+import copy
+import queue
+import atexit
+import logging
+import threading
+
+from logging.handlers import QueueHandler, QueueListener
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue, drained by a :class:`QueueListener`
+    thread which formats them and calls the real handlers. When the queue is
+    full the record is dropped rather than blocking the caller; the writer
+    thread reports how many were dropped once it catches up.
+
+    :param handlers: the handlers doing the actual output
+    :param maxsize: queue capacity, in records
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        super(BoundedQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        self._pid = None
+        self.start()
+        atexit.register(self.stop)
+
+    def start(self):
+        # one writer per process, the thread doesn't survive a fork
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._listener = _Listener(
+                self.queue,
+                _DropReporter(self),
+                *self.handlers,
+                respect_handler_level=True
+            )
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """
+        Flushes the queue and stops the writer thread.
+        """
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def prepare(self, record):
+        """
+        Merges the arguments into the message, which must happen before they
+        change, and leaves the formatting to the writer thread.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self.start()
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may be full, but the writer thread is draining it
+        self.queue.put(self._sentinel)
+
+
+class _DropReporter(logging.Handler):
+    """
+    Runs on the writer thread before the real handlers and logs a warning
+    when records were dropped since the last one.
+    """
+
+    def __init__(self, queue_handler):
+        super(_DropReporter, self).__init__()
+        self.queue_handler = queue_handler
+
+    def emit(self, record):
+        with self.queue_handler._lock:
+            dropped, self.queue_handler.dropped = self.queue_handler.dropped, 0
+        if not dropped:
+            return
+
+        warning = logging.LogRecord(
+            record.name,
+            logging.WARNING,
+            __file__,
+            0,
+            "Logging queue full, dropped {0} records".format(dropped),
+            None,
+            None,
+        )
+        for handler in self.queue_handler.handlers:
+            if warning.levelno >= handler.level:
+                handler.handle(warning)
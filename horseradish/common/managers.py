@@ -44,8 +44,9 @@ class InstanceManager(object):
         """
         class_list = list(self.get_class_list())
         if not class_list:
-            self.cache = []
-            return []
+            if self.cache is None:
+                self.cache = []
+            return self.cache
 
         if self.cache is not None:
             return self.cache
@@ -7,18 +7,56 @@
 .. moduleauthor:: Sam Havron <havron@hey.com>
 
 """
-from functools import wraps
-from flask import request, current_app
+from functools import wraps, lru_cache
+from flask import request, current_app, json, Response, stream_with_context
 
 from sqlalchemy.orm.collections import InstrumentedList
 
 from inflection import camelize, underscore
-from marshmallow import Schema, post_dump, pre_load
+from marshmallow import Schema, SchemaMeta, fields, post_dump, pre_load
 
 from horseradish.extensions import sentry
+from horseradish.common.utils import NDJSON_MIMETYPE, wants_ndjson
 
 
-class HorseradishSchema(Schema):
+@lru_cache(maxsize=4096)
+def under_key(key):
+    return underscore(key)
+
+
+@lru_cache(maxsize=4096)
+def camel_key(key):
+    return camelize(key, uppercase_first_letter=False)
+
+
+class HorseradishSchemaMeta(SchemaMeta):
+    """
+    Translates the field names of a schema class to camelCase and back once,
+    when the class is defined, so that converting the keys of a row is a dict
+    lookup instead of a regex substitution. Keys that aren't fields go through
+    the memoized `under_key` and `camel_key`.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(HorseradishSchemaMeta, cls).__init__(name, bases, attrs)
+
+        names = set()
+        for field_name, field in cls._declared_fields.items():
+            names.add(field_name)
+            for attr in ("load_from", "dump_to", "data_key"):
+                if getattr(field, attr, None):
+                    names.add(getattr(field, attr))
+
+        cls._under_keys = {}
+        cls._camel_keys = {}
+        for key in names:
+            camel = camel_key(key)
+            cls._camel_keys[key] = camel
+            cls._under_keys[key] = under_key(key)
+            cls._under_keys[camel] = under_key(camel)
+
+
+class HorseradishSchema(Schema, metaclass=HorseradishSchemaMeta):
     """
     Base schema from which all grouper schema's inherit
     """
@@ -26,28 +64,22 @@ class HorseradishSchema(Schema):
     __envelope__ = True
 
     def under(self, data, many=None):
-        items = []
+        keys = self._under_keys
         if many:
-            for i in data:
-                items.append({underscore(key): value for key, value in i.items()})
-            return items
-        return {underscore(key): value for key, value in data.items()}
+            return [
+                {keys.get(key) or under_key(key): value for key, value in i.items()}
+                for i in data
+            ]
+        return {keys.get(key) or under_key(key): value for key, value in data.items()}
 
     def camel(self, data, many=None):
-        items = []
+        keys = self._camel_keys
         if many:
-            for i in data:
-                items.append(
-                    {
-                        camelize(key, uppercase_first_letter=False): value
-                        for key, value in i.items()
-                    }
-                )
-            return items
-        return {
-            camelize(key, uppercase_first_letter=False): value
-            for key, value in data.items()
-        }
+            return [
+                {keys.get(key) or camel_key(key): value for key, value in i.items()}
+                for i in data
+            ]
+        return {keys.get(key) or camel_key(key): value for key, value in data.items()}
 
     def wrap_with_envelope(self, data, many):
         if many:
@@ -97,6 +129,173 @@ class HorseradishOutputSchema(HorseradishSchema):
             return data
 
 
+_missing = object()
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return str(value)
+
+
+def _boolean(value):
+    if value in fields.Boolean.truthy:
+        return True
+    if value in fields.Boolean.falsy:
+        return False
+    return bool(value)
+
+
+class CompiledSerializer(object):
+    """
+    Dumps objects for schemas made of scalar fields, and nested schemas of
+    the same kind, without going through marshmallow: one attribute lookup
+    and one conversion per field, with the output keys worked out up front.
+    Build one with :meth:`compile`, which returns None for schemas that need
+    marshmallow (other field types, custom dump hooks).
+    """
+
+    CONVERTERS = {
+        fields.Integer: int,
+        fields.String: _text,
+        fields.Email: _text,
+        fields.Boolean: _boolean,
+    }
+
+    def __init__(self, columns, many):
+        # (attribute, output key, converter, is a nested many)
+        self.columns = columns
+        self.many = many
+
+    @staticmethod
+    def _dump_hooks(schema_class):
+        hooks = set()
+        for name in dir(schema_class):
+            attr = getattr(schema_class, name, None)
+            tags = getattr(attr, "__marshmallow_tags__", None) or getattr(
+                attr, "__marshmallow_hook__", ()
+            )
+            for tag in tags:
+                tag_name = tag[0] if isinstance(tag, tuple) else tag
+                if tag_name in ("pre_dump", "post_dump"):
+                    hooks.add(getattr(attr, "__func__", attr))
+        return hooks
+
+    @classmethod
+    def compile(cls, schema, _seen=()):
+        """
+        :param schema: schema instance
+        :return: a serializer, or None when the schema isn't eligible
+        """
+        schema_class = type(schema)
+        if schema_class in _seen:
+            return None
+
+        hooks = cls._dump_hooks(schema_class)
+        camel = HorseradishOutputSchema.post_process in hooks
+        if hooks - {HorseradishOutputSchema.post_process}:
+            return None
+
+        keys = getattr(schema_class, "_camel_keys", {})
+        columns = []
+        for name, field in schema.fields.items():
+            if getattr(field, "load_only", False):
+                continue
+
+            if type(field) is fields.Nested:
+                nested = cls.compile(field.schema, _seen + (schema_class,))
+                if nested is None:
+                    return None
+                convert = nested.dump_one
+                many = field.many
+            else:
+                convert = cls.CONVERTERS.get(type(field))
+                if convert is None:
+                    return None
+                many = False
+
+            key = getattr(field, "dump_to", None) or getattr(field, "data_key", None)
+            key = key or name
+            if camel:
+                key = keys.get(key) or camel_key(key)
+            columns.append((field.attribute or name, key, convert, many))
+
+        return cls(columns, schema.many)
+
+    def dump_one(self, obj):
+        data = {}
+        for attr, key, convert, many in self.columns:
+            if isinstance(obj, dict):
+                value = obj.get(attr, _missing)
+            else:
+                value = getattr(obj, attr, _missing)
+            if value is _missing:
+                continue
+
+            if value is None:
+                data[key] = None
+            elif many:
+                data[key] = [convert(v) for v in value]
+            else:
+                data[key] = convert(value)
+        return data
+
+    def dump(self, obj, many=None):
+        many = self.many if many is None else many
+        if many:
+            return [self.dump_one(o) for o in obj]
+        return self.dump_one(obj)
+
+
+_schemas = {}
+_serializers = {}
+
+
+def get_schema(schema_class, many=False):
+    """
+    Returns a shared instance of a schema class.
+
+    :param schema_class:
+    :param many:
+    :return:
+    """
+    key = (schema_class, many)
+    if key not in _schemas:
+        _schemas[key] = schema_class(many=many)
+    return _schemas[key]
+
+
+def get_serializer(schema):
+    """
+    Returns the compiled serializer of a schema instance, or the schema
+    itself when it has to go through marshmallow.
+
+    :param schema:
+    :return:
+    """
+    serializer = _serializers.get(schema)
+    if serializer is None:
+        serializer = CompiledSerializer.compile(schema) or schema
+        _serializers[schema] = serializer
+    return serializer
+
+
+def dump(schema, data, many=None):
+    """
+    Serializes `data` with a schema, through its compiled serializer when it
+    has one.
+
+    :param schema:
+    :param data:
+    :param many: defaults to the schema's own
+    :return:
+    """
+    serializer = get_serializer(schema)
+    if serializer is schema:
+        return schema.dump(data, many=many).data
+    return serializer.dump(data, many=many)
+
+
 def format_errors(messages):
     errors = {}
     for k, v in messages.items():
@@ -117,29 +316,124 @@ def wrap_errors(messages):
     return errors
 
 
+def wants_stream(args):
+    """
+    Tells whether a list endpoint should stream its page, which it does when
+    asked with `stream` or when the client prefers NDJSON. Passed on to
+    `database.sort_and_page` as the `stream` argument.
+
+    :param args: arguments parsed with `paginated_parser`
+    :return:
+    """
+    return bool(args.get("stream")) or wants_ndjson()
+
+
+def stream_pagination(data, output_schema):
+    """
+    Writes a page whose items are still a query out chunk by chunk, marshaling
+    HORSERADISH_STREAM_BATCH_SIZE rows at a time. The body is the usual
+    {"total": ..., "items": [...]} envelope, or one item per line when the
+    client asks for NDJSON, with the total in the X-Total-Count header and the
+    cursor of the next page, if any, in the X-Next-Cursor header.
+
+    :param data: page returned by `database.sort_and_page`
+    :param output_schema:
+    :return:
+    """
+    batch_size = current_app.config.get("HORSERADISH_STREAM_BATCH_SIZE", 500)
+
+    def batches():
+        batch = []
+        for item in data["items"]:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield dump(output_schema, batch, many=True)
+                batch = []
+        if batch:
+            yield dump(output_schema, batch, many=True)
+
+    def generate_ndjson():
+        for batch in batches():
+            yield "".join(json.dumps(item) + "\n" for item in batch)
+
+    def generate_json():
+        yield '{{"total": {0}, "totalStrategy": {1}, '.format(
+            json.dumps(data["total"]), json.dumps(data.get("total_strategy"))
+        )
+        if "truncated" in data:
+            yield '"truncated": {0}, '.format(json.dumps(data["truncated"]))
+        yield '"items": ['
+        separator = ""
+        for batch in batches():
+            for item in batch:
+                yield separator + json.dumps(item)
+                separator = ","
+        if "next_cursor" in data:
+            yield '], "nextCursor": {0}}}'.format(json.dumps(data["next_cursor"]))
+        else:
+            yield "]}"
+
+    if wants_ndjson():
+        response = Response(
+            stream_with_context(generate_ndjson()), mimetype=NDJSON_MIMETYPE
+        )
+    else:
+        response = Response(
+            stream_with_context(generate_json()), mimetype="application/json"
+        )
+
+    if data["total"] is not None:
+        response.headers["X-Total-Count"] = str(data["total"])
+    if data.get("total_strategy"):
+        response.headers["X-Total-Strategy"] = data["total_strategy"]
+    if data.get("truncated"):
+        response.headers["X-Truncated"] = "true"
+    if data.get("next_cursor"):
+        response.headers["X-Next-Cursor"] = data["next_cursor"]
+    return response
+
+
 def unwrap_pagination(data, output_schema):
     if not output_schema:
         return data
 
     if isinstance(data, dict):
+        if "total" in data.keys() and not isinstance(data["items"], list):
+            return stream_pagination(data, output_schema)
+
         if "total" in data.keys():
+            marshaled_data = {"total": data["total"]}
+            if "total_strategy" in data:
+                marshaled_data["totalStrategy"] = data["total_strategy"]
+            if "truncated" in data:
+                marshaled_data["truncated"] = data["truncated"]
+
             if data.get("total") == 0:
-                return data
+                marshaled_data["items"] = []
+                return marshaled_data
 
-            marshaled_data = {"total": data["total"]}
-            marshaled_data["items"] = output_schema.dump(data["items"], many=True).data
+            marshaled_data["items"] = dump(output_schema, data["items"], many=True)
+            if "next_cursor" in data:
+                marshaled_data["nextCursor"] = data["next_cursor"]
             return marshaled_data
 
-        return output_schema.dump(data).data
+        return dump(output_schema, data)
 
     elif isinstance(data, list):
         marshaled_data = {"total": len(data)}
-        marshaled_data["items"] = output_schema.dump(data, many=True).data
+        marshaled_data["items"] = dump(output_schema, data, many=True)
         return marshaled_data
-    return output_schema.dump(data).data
+    return dump(output_schema, data)
 
 
 def validate_schema(input_schema, output_schema):
+    # schema classes get a shared instance, and every output schema is
+    # compiled once here rather than on each request
+    if isinstance(output_schema, type):
+        output_schema = get_schema(output_schema)
+    if output_schema:
+        get_serializer(output_schema)
+
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
@@ -169,12 +463,10 @@ def validate_schema(input_schema, output_schema):
             if not resp:
                 return dict(message="No data found"), 404
 
-            if callable(output_schema):
-                output_schema_to_use = output_schema()
-            else:
-                output_schema_to_use = output_schema
-
-            return unwrap_pagination(resp, output_schema_to_use), 200
+            resp = unwrap_pagination(resp, output_schema)
+            if isinstance(resp, Response):
+                return resp
+            return resp, 200
 
         return decorated_function
 
@@ -11,6 +11,8 @@ import string
 import random
 
 import sqlalchemy
+from flask import request
+from flask_restful import inputs
 from flask_restful.reqparse import RequestParser
 from sqlalchemy import and_, func
 
@@ -24,6 +26,26 @@ paginated_parser.add_argument("sortDir", type=str, dest="sort_dir", location="ar
 paginated_parser.add_argument("sortBy", type=str, dest="sort_by", location="args")
 paginated_parser.add_argument("filter", type=str, location="args")
 paginated_parser.add_argument("owner", type=str, location="args")
+paginated_parser.add_argument("cursor", type=str, location="args")
+paginated_parser.add_argument(
+    "total",
+    type=str,
+    choices=("exact", "estimate", "cached", "none"),
+    location="args",
+)
+paginated_parser.add_argument(
+    "stream", type=inputs.boolean, default=False, location="args"
+)
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def wants_ndjson():
+    """
+    Tells whether the client prefers newline delimited JSON over JSON.
+    """
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
 
 
 def base64encode(string):
@@ -59,16 +81,16 @@ def validate_conf(app, required_vars):
 
 
 # https://bitbucket.org/zzzeek/sqlalchemy/wiki/UsageRecipes/WindowedRangeQuery
-def column_windows(session, column, windowsize):
+def column_windows(session, column, windowsize, where=None):
     """Return a series of WHERE clauses against
     a given column that break it into windows.
     Result is an iterable of tuples, consisting of
     ((start, end), whereclause), where (start, end) are the ids.
     Requires a database that supports window functions,
     i.e. Postgresql, SQL Server, Oracle.
-    Enhance this yourself !  Add a "where" argument
-    so that windows of just a subset of rows can
-    be computed.
+    When `where` is given, only the rows matching it
+    are numbered, so that the windows of just a subset
+    of rows are computed.
     """
 
     def int_for_range(start_id, end_id):
@@ -77,9 +99,10 @@ def column_windows(session, column, windowsize):
         else:
             return column >= start_id
 
-    q = session.query(
-        column, func.row_number().over(order_by=column).label("rownum")
-    ).from_self(column)
+    q = session.query(column, func.row_number().over(order_by=column).label("rownum"))
+    if where is not None:
+        q = q.filter(where)
+    q = q.from_self(column)
 
     if windowsize > 1:
         q = q.filter(sqlalchemy.text("rownum %% %d=1" % windowsize))
@@ -95,10 +118,11 @@ def column_windows(session, column, windowsize):
         yield int_for_range(start, end)
 
 
-def windowed_query(q, column, windowsize):
-    """"Break a Query into windows on a given column."""
+def windowed_query(q, column, windowsize, where=None):
+    """Break a Query into windows on a given column, computed over the rows
+    matching `where` (see `column_windows`)."""
 
-    for whereclause in column_windows(q.session, column, windowsize):
+    for whereclause in column_windows(q.session, column, windowsize, where):
         for row in q.filter(whereclause).order_by(column):
             yield row
 
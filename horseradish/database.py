@@ -9,14 +9,29 @@
 
 .. moduleauthor:: Sam Havron <havron@hey.com>
 """
+import json
+import time
+import base64
+import binascii
+import threading
+
+from contextlib import contextmanager
+from datetime import date, datetime
+
+from flask import current_app, g, has_app_context, has_request_context, request
 from inflection import underscore
-from sqlalchemy import exc, func, distinct
+from sqlalchemy import event, exc, func, distinct, inspect, text, Index, Table
 from sqlalchemy.orm import make_transient, lazyload
 from sqlalchemy.sql import and_, or_
+from sqlalchemy.sql.elements import BooleanClauseList
 
+from horseradish.common.cache import TTLCache
 from horseradish.exceptions import AttrNotFound, DuplicateError
 from horseradish.extensions import db
 
+# row counts by query, HORSERADISH_COUNT_CACHE_SIZE / HORSERADISH_COUNT_CACHE_TTL
+count_cache = TTLCache(maxsize=1024, ttl=30, config_prefix="HORSERADISH_COUNT_CACHE")
+
 
 def filter_none(kwargs):
     """
@@ -33,17 +48,189 @@ def filter_none(kwargs):
     return n_kwargs
 
 
+# seconds the replica is behind, 0 when it has replayed everything it received
+REPLICA_LAG = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+READ_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+
+class ReadRouter(object):
+    """
+    Sends the reads of GET requests to a replica, configured as the "reader"
+    entry of ``SQLALCHEMY_BINDS``. Writes, and the reads of any other request,
+    stay on the primary.
+
+    A request reads from the primary instead when:
+
+    - the replica is more than ``SQLALCHEMY_READER_MAX_LAG`` seconds behind,
+      or can't be reached. The lag is checked at most every
+      ``SQLALCHEMY_READER_LAG_CHECK_INTERVAL`` seconds.
+    - the request already committed something, or runs inside `primary()`,
+      as the lookups behind cached tokens do.
+    - its client wrote something within the last
+      ``SQLALCHEMY_READER_STICKY_SECONDS``, so that it reads its own writes.
+      The client is recognized by a cookie, and by its user id in this
+      process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.session = None
+        self.engine = None
+        self.max_lag = 10
+        self.interval = 5
+        self.window = 15
+        self.cookie = "horseradish_primary"
+        self.sticky = TTLCache(maxsize=10000, ttl=self.window)
+        self.healthy = False
+        self._next_check = 0
+
+    def init_app(self, app):
+        """Initializes the application with the extension.
+
+        :param app: The Flask application object.
+        """
+        self.max_lag = app.config.get("SQLALCHEMY_READER_MAX_LAG", 10)
+        self.interval = app.config.get("SQLALCHEMY_READER_LAG_CHECK_INTERVAL", 5)
+        # a lag under max_lag may go unnoticed for up to interval
+        self.window = app.config.get(
+            "SQLALCHEMY_READER_STICKY_SECONDS", self.max_lag + self.interval
+        )
+        self.sticky = TTLCache(maxsize=10000, ttl=self.window)
+        self.healthy = False
+        self._next_check = 0
+
+        if "reader" not in (app.config.get("SQLALCHEMY_BINDS") or {}):
+            self.session = self.engine = None
+            return
+
+        self.engine = db.get_engine(app, bind="reader")
+        self.session = db.create_scoped_session(
+            options=dict(bind=self.engine, binds={}, info={"reader": True})
+        )
+
+        if not event.contains(db.session, "after_commit", _mark_write):
+            event.listen(db.session, "after_commit", _mark_write)
+
+        app.after_request(self._stick)
+        app.teardown_appcontext(self._teardown)
+
+    def _stick(self, response):
+        if g.get("_wrote"):
+            response.set_cookie(self.cookie, "1", max_age=self.window, httponly=True)
+            if g.get("current_user_id") is not None:
+                self.sticky.set(g.current_user_id, True)
+        return response
+
+    def _teardown(self, exception=None):
+        if self.session is not None:
+            self.session.remove()
+
+    def check_lag(self):
+        """
+        Tells whether the replica is caught up enough to be read from.
+
+        :return:
+        """
+        if time.monotonic() < self._next_check or not self._lock.acquire(False):
+            return self.healthy
+
+        try:
+            self._next_check = time.monotonic() + self.interval
+            lag = 0
+            if self.engine.dialect.name == "postgresql":
+                lag = self.engine.execute(REPLICA_LAG).scalar() or 0
+            self.healthy = lag <= self.max_lag
+            if not self.healthy:
+                current_app.logger.warning(
+                    "Replica is {0:.1f}s behind, reading from the primary".format(lag)
+                )
+        except exc.SQLAlchemyError as e:
+            self.healthy = False
+            current_app.logger.warning(
+                "Replica unavailable, reading from the primary: {0}".format(e)
+            )
+        finally:
+            self._lock.release()
+        return self.healthy
+
+    def routes(self):
+        """
+        Tells whether the reads of the current request go to the replica.
+
+        :return:
+        """
+        if self.session is None or not has_request_context():
+            return False
+        if request.method not in READ_METHODS:
+            return False
+        if g.get("_wrote") or g.get("_primary"):
+            return False
+        if request.cookies.get(self.cookie):
+            return False
+        if g.get("current_user_id") in self.sticky:
+            return False
+        return self.check_lag()
+
+
+def _mark_write(session):
+    if not session.info.get("reader") and has_request_context():
+        g._wrote = True
+
+
+read_router = ReadRouter()
+
+
+def reader():
+    """
+    Returns the session reads should go through: the replica's during a GET
+    request, see :class:`ReadRouter`, and the primary's otherwise. Objects
+    read from the replica must not be written back.
+
+    :return: a session
+    """
+    if read_router.routes():
+        return read_router.session
+    return db.session
+
+
+@contextmanager
+def primary():
+    """
+    Reads from the primary within the block, e.g. for data that must not be
+    stale even by the replica lag.
+    """
+    if not has_app_context():
+        yield
+        return
+
+    previous = g.get("_primary", False)
+    g._primary = True
+    try:
+        yield
+    finally:
+        g._primary = previous
+
+
 def session_query(model):
     """
-    Returns a SQLAlchemy query object for the specified `model`.
+    Returns a SQLAlchemy query object for the specified `model`, on the
+    session returned by `reader()`.
 
-    If `model` has a ``query`` attribute already, that object will be returned.
-    Otherwise a query will be created and returned based on `session`.
+    If `model` has a ``query`` attribute already and we read from the primary,
+    that object will be returned. Otherwise a query will be created and
+    returned based on `session`.
 
     :param model: sqlalchemy model
     :return: query object for model
     """
-    return model.query if hasattr(model, "query") else db.session.query(model)
+    session = reader()
+    if session is db.session and hasattr(model, "query"):
+        return model.query
+    return session.query(model)
 
 
 def create_query(model, kwargs):
@@ -104,6 +291,9 @@ def find_all(query, model, kwargs):
 
         conditions.append(get_model_column(model, attr).in_(value))
 
+    # an empty and_() still counts as a WHERE clause
+    if not conditions:
+        return query
     return query.filter(and_(*conditions))
 
 
@@ -190,17 +380,61 @@ def delete(model):
         db.session.commit()
 
 
+def trigram_indexes(model):
+    """
+    Declares a GIN trigram index on each of the `searchable_fields` of a
+    model. Postgres uses them to serve the ILIKE '%term%' lookups made by
+    `filter`, which would otherwise scan the whole table. Needs the pg_trgm
+    extension.
+
+    :param model:
+    """
+    for field in model.searchable_fields:
+        Index(
+            "ix_{0}_{1}_trgm".format(model.__tablename__, field),
+            getattr(model, field),
+            postgresql_using="gin",
+            postgresql_ops={field: "gin_trgm_ops"},
+        )
+
+
 def filter(query, model, terms):
     """
     Helper that searched for 'like' strings in column values.
 
+    On the `searchable_fields` of a model the matches are ranked by trigram
+    similarity to the term, best first, and only the best SEARCH_MAX_RESULTS
+    are kept. When more rows match, the query is marked with the
+    `search_truncated` execution option, which `sort_and_page` reports as
+    `truncated`. An explicit sort replaces the ranking.
+
     :param query:
     :param model:
     :param terms:
     :return:
     """
     column = get_model_column(model, underscore(terms[0]))
-    return query.filter(column.ilike("%{}%".format(terms[1])))
+    condition = column.ilike("%{}%".format(terms[1]))
+
+    searchable = getattr(model, "searchable_fields", ())
+    if column.key not in searchable or db.engine.name != "postgresql":
+        return query.filter(condition)
+
+    pk = get_primary_key(model)
+    rank = func.similarity(column, terms[1]).desc()
+    limit = current_app.config.get("SEARCH_MAX_RESULTS", 1000)
+    best = db.session.query(pk).filter(condition).order_by(rank, pk).limit(limit)
+
+    # is there a match past the limit
+    truncated = (
+        db.session.query(pk).filter(condition).offset(limit).limit(1).first()
+        is not None
+    )
+    return (
+        query.filter(pk.in_(best))
+        .order_by(rank, pk)
+        .execution_options(search_truncated=truncated)
+    )
 
 
 def sort(query, model, field, direction):
@@ -214,7 +448,9 @@ def sort(query, model, field, direction):
     :param direction:
     """
     column = get_model_column(model, underscore(field))
-    return query.order_by(column.desc() if direction == "desc" else column.asc())
+    return query.order_by(None).order_by(
+        column.desc() if direction == "desc" else column.asc()
+    )
 
 
 def paginate(query, page, count):
@@ -233,24 +469,27 @@ def update_list(model, model_attr, item_model, items):
     Helper that correctly updates a models items
     depending on what has changed
 
+    Items are compared by id; the ones that are new are fetched with a single
+    IN query.
+
     :param model_attr:
     :param item_model:
     :param items:
     :param model:
     :return:
     """
-    ids = []
+    collection = getattr(model, model_attr)
+    ids = {i["id"] for i in items}
 
-    for i in getattr(model, model_attr):
-        if i.id not in ids:
-            getattr(model, model_attr).remove(i)
+    for item in [item for item in collection if item.id not in ids]:
+        collection.remove(item)
 
-    for i in items:
-        for item in getattr(model, model_attr):
-            if item.id == i["id"]:
-                break
-        else:
-            getattr(model, model_attr).append(get(item_model, i["id"]))
+    missing = ids - {item.id for item in collection}
+    if missing:
+        column = get_model_column(item_model, "id")
+        # appended to a model of the primary session, whatever the request
+        for item in db.session.query(item_model).filter(column.in_(missing)):
+            collection.append(item)
 
     return model
 
@@ -306,10 +545,268 @@ def get_count(q):
     return count
 
 
+def has_criteria(clause):
+    """
+    Tells whether a WHERE clause actually restricts anything, i.e. isn't
+    missing or an empty conjunction.
+
+    :param clause:
+    :return:
+    """
+    if clause is None:
+        return False
+    if isinstance(clause, BooleanClauseList):
+        return any(has_criteria(c) for c in clause.clauses)
+    return True
+
+
+def estimate_count(q):
+    """
+    Returns the planner's row estimate for a query instead of counting the rows.
+    Cheap regardless of the table size, but only as good as the table
+    statistics.
+
+    An unfiltered query over a single table is answered from
+    `pg_class.reltuples`, anything else from the plan of an EXPLAIN.
+
+    :param q:
+    :return:
+    """
+    statement = q.options(lazyload("*")).statement.order_by(None)
+    froms = statement.froms
+    if (
+        not has_criteria(q.whereclause)
+        and not q._group_by
+        and not q._distinct
+        and len(froms) == 1
+        and isinstance(froms[0], Table)
+    ):
+        reltuples = q.session.execute(
+            text("SELECT reltuples FROM pg_class WHERE oid = CAST(:name AS regclass)"),
+            {"name": froms[0].fullname},
+        ).scalar()
+        # -1 or 0 until the table was first vacuumed or analyzed
+        if reltuples and reltuples > 0:
+            return int(reltuples)
+
+    compiled = statement.compile(dialect=q.session.get_bind().dialect)
+    plan = (
+        q.session.connection()
+        .execute("EXPLAIN (FORMAT JSON) {0}".format(compiled), compiled.params)
+        .scalar()
+    )
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def cached_count(q):
+    """
+    Exact count of a query, memoized for a few seconds per query signature,
+    i.e. its SQL and bound parameters. Repeated list requests with the same
+    filters then share one count.
+
+    :param q:
+    :return:
+    """
+    statement = q.statement.order_by(None)
+    compiled = statement.compile(dialect=q.session.get_bind().dialect)
+    key = (
+        str(compiled),
+        tuple(sorted((k, repr(v)) for k, v in compiled.params.items())),
+    )
+
+    count = count_cache.get(key)
+    if count is None:
+        count = get_count(q)
+        count_cache.set(key, count)
+    return count
+
+
+def count_query(q, strategy="exact"):
+    """
+    Counts the rows of a query with the given strategy.
+
+    :param q:
+    :param strategy: exact, estimate, cached or none
+    :return: the row count, None when the strategy is none
+    """
+    if strategy == "none":
+        return None
+    if strategy == "estimate":
+        return estimate_count(q)
+    if strategy == "cached":
+        return cached_count(q)
+    return get_count(q)
+
+
+def default_count_strategy(model):
+    """
+    The counting strategy of a model's numbered pages, from
+    HORSERADISH_COUNT_STRATEGIES (a dict of table name -> strategy).
+
+    :param model:
+    :return:
+    """
+    strategies = current_app.config.get("HORSERADISH_COUNT_STRATEGIES", {})
+    return strategies.get(model.__tablename__, "exact")
+
+
+def get_primary_key(model):
+    """
+    Returns the (first) primary key column of a model.
+
+    :param model:
+    :return:
+    """
+    return inspect(model).primary_key[0]
+
+
+def encode_cursor(values):
+    """
+    Encodes the sort key of the last row of a page as an opaque cursor.
+
+    :param values:
+    :return:
+    """
+    data = json.dumps(values, default=lambda v: v.isoformat(), separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by :func:`encode_cursor`.
+
+    :param cursor:
+    :return: :raise ValueError:
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid cursor: {0}".format(cursor))
+
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor: {0}".format(cursor))
+    return values
+
+
+def coerce_cursor(cursor, column, pk):
+    """
+    Checks the values of a decoded cursor against the types of the sort
+    column and primary key, so that a tampered cursor is rejected here rather
+    than by the database. Dates come back as the datetimes they were encoded
+    from.
+
+    :param cursor: decoded cursor
+    :param column: the sort column, or None
+    :param pk: primary key column
+    :return: the cursor, with its values converted
+    :raise ValueError:
+    """
+    values = []
+    for value, col in zip(cursor, (column, pk)):
+        if value is None:
+            if col is pk:
+                raise ValueError("Invalid cursor")
+            values.append(value)
+            continue
+
+        if col is None:
+            raise ValueError("Invalid cursor")
+
+        try:
+            python_type = col.type.python_type
+        except NotImplementedError:
+            values.append(value)
+            continue
+
+        if python_type in (datetime, date):
+            if not isinstance(value, str):
+                raise ValueError("Invalid cursor")
+            value = datetime.fromisoformat(value)
+            if python_type is date:
+                value = value.date()
+        elif python_type is float:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError("Invalid cursor")
+        elif python_type is int:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError("Invalid cursor")
+        elif not isinstance(value, python_type):
+            raise ValueError("Invalid cursor")
+        values.append(value)
+    return values
+
+
+def seek(query, column, pk, direction, cursor):
+    """
+    Orders a query by `column` with the primary key as a tie-breaker, and
+    restricts it to the rows that come after `cursor`. NULLs sort last
+    ascending and first descending, as they do in Postgres.
+
+    :param query:
+    :param column: the sort column, or None to order by primary key only
+    :param pk: primary key column
+    :param direction: asc or desc
+    :param cursor: decoded cursor, or None for the first page
+    :return:
+    """
+    desc = direction == "desc"
+    query = query.order_by(None)
+
+    if column is None:
+        query = query.order_by(pk.desc() if desc else pk.asc())
+        if cursor:
+            query = query.filter(pk < cursor[1] if desc else pk > cursor[1])
+        return query
+
+    query = query.order_by(
+        column.desc() if desc else column.asc(), pk.desc() if desc else pk.asc()
+    )
+    if not cursor:
+        return query
+
+    value, last_id = cursor
+    after_id = pk < last_id if desc else pk > last_id
+
+    if value is None:
+        if desc:
+            condition = or_(column.isnot(None), and_(column.is_(None), after_id))
+        else:
+            condition = and_(column.is_(None), after_id)
+    else:
+        after_value = column < value if desc else column > value
+        condition = or_(after_value, and_(column == value, after_id))
+        if not desc:
+            condition = or_(condition, column.is_(None))
+
+    return query.filter(condition)
+
+
 def sort_and_page(query, model, args):
     """
     Helper that allows us to combine sorting and paging
 
+    Pages are addressed either by number (`page`) or, when a `cursor` is
+    given, by keyset: the rows after the sort key encoded in the cursor. An
+    empty cursor requests the first page. Keyset pages cost the same no matter
+    how deep they are and return a `next_cursor`, which is None on the last
+    page. A cursor that can't be decoded, or whose values don't fit the sort
+    column, gets a 400 response.
+
+    `total` selects how the total is counted: exact, estimate, cached or none.
+    It defaults to the model's strategy (see `default_count_strategy`) for
+    numbered pages and to none for keyset pages. The strategy used is returned
+    as `total_strategy`. When a search was cut at SEARCH_MAX_RESULTS (see
+    `filter`), `truncated` is returned as well, and the total only counts the
+    rows that were kept.
+
+    With `stream` (see `common.schema.wants_stream`) the items are returned as
+    a query iterated with `yield_per`, so that the rows can be marshaled and
+    written out in batches (see `common.schema.stream_pagination`) instead of
+    being loaded all at once. On keyset pages the next cursor is then read
+    beforehand, from the sort key of the last row.
+
     :param query:
     :param model:
     :param args:
@@ -319,18 +816,73 @@ def sort_and_page(query, model, args):
     sort_dir = args.pop("sort_dir")
     page = args.pop("page")
     count = args.pop("count")
+    cursor = args.pop("cursor", None)
+    total_strategy = args.pop("total", None)
+    stream = args.pop("stream", False)
+    batch_size = current_app.config.get("HORSERADISH_STREAM_BATCH_SIZE", 500)
+    truncated = query.get_execution_options().get("search_truncated")
 
     if args.get("user"):
         user = args.pop("user")
 
     query = find_all(query, model, args)
 
-    if sort_by and sort_dir:
-        query = sort(query, model, sort_by, sort_dir)
+    if cursor is None:
+        if sort_by and sort_dir:
+            query = sort(query, model, sort_by, sort_dir)
 
-    total = get_count(query)
+        total_strategy = total_strategy or default_count_strategy(model)
+        total = count_query(query, total_strategy)
 
-    # offset calculated at zero
-    page -= 1
-    items = query.offset(count * page).limit(count).all()
-    return dict(items=items, total=total)
+        # offset calculated at zero
+        page -= 1
+        query = query.offset(count * page).limit(count)
+        if stream:
+            items = query.yield_per(batch_size)
+        else:
+            items = query.all()
+        result = dict(items=items, total=total, total_strategy=total_strategy)
+        if truncated is not None:
+            result["truncated"] = truncated
+        return result
+
+    column = get_model_column(model, underscore(sort_by)) if sort_by else None
+    pk = get_primary_key(model)
+    try:
+        cursor = coerce_cursor(decode_cursor(cursor), column, pk) if cursor else None
+    except ValueError:
+        return dict(message="Invalid cursor"), 400
+
+    total_strategy = total_strategy or "none"
+    total = count_query(query, total_strategy)
+
+    query = seek(query, column, pk, sort_dir, cursor)
+
+    next_cursor = None
+    if stream:
+        # the sort keys of the last row and of the one after it, if any
+        keys = query.with_entities(column if column is not None else pk, pk)
+        keys = keys.offset(count - 1).limit(2).all()
+        if len(keys) > 1:
+            last_value, last_pk = keys[0]
+            last_value = last_value if column is not None else None
+            next_cursor = encode_cursor([last_value, last_pk])
+        items = query.limit(count).yield_per(batch_size)
+    else:
+        # fetch one extra row to find out whether there is a next page
+        items = query.limit(count + 1).all()
+        if len(items) > count:
+            items = items[:count]
+            last = items[-1]
+            last_value = getattr(last, column.key) if column is not None else None
+            next_cursor = encode_cursor([last_value, getattr(last, pk.key)])
+
+    result = dict(
+        items=items,
+        total=total,
+        total_strategy=total_strategy,
+        next_cursor=next_cursor,
+    )
+    if truncated is not None:
+        result["truncated"] = truncated
+    return result
@@ -44,3 +44,7 @@ class InvalidAuthority(Exception):
 
 class UnknownProvider(Exception):
     pass
+
+
+class JwksUnavailable(Exception):
+    pass
@@ -19,11 +19,27 @@ from logging import Formatter, StreamHandler
 from logging.handlers import RotatingFileHandler
 
 from flask import Flask
-from flask_replicated import FlaskReplicated
 import logmatic
 
 from horseradish.common.health import mod as health
-from horseradish.extensions import db, migrate, principal, metrics, sentry, cors
+from horseradish.extensions import (
+    db,
+    migrate,
+    bcrypt,
+    principal,
+    metrics,
+    sentry,
+    cors,
+)
+from horseradish.auth.passwords import password_hasher
+from horseradish.auth.cache import token_cache
+from horseradish.auth.idp import idp_client
+from horseradish.auth.ldap import ldap_pool, group_cache
+from horseradish.roles.service import role_ids
+from horseradish.database import count_cache, read_router
+from horseradish.api_keys.revocations import revocation_index
+from horseradish.common.green import patch_drivers
+from horseradish.common.logs import BoundedQueueHandler
 
 DEFAULT_BLUEPRINTS = (health,)
 
@@ -130,10 +146,19 @@ def configure_extensions(app):
     """
     db.init_app(app)
     migrate.init_app(app, db)
+    bcrypt.init_app(app)
+    password_hasher.init_app(app)
     principal.init_app(app)
     # smtp_mail.init_app(app)
-    # metrics.init_app(app)
+    metrics.init_app(app)
     sentry.init_app(app)
+    token_cache.init_app(app)
+    idp_client.init_app(app)
+    ldap_pool.init_app(app)
+    group_cache.init_app(app)
+    role_ids.init_app(app)
+    count_cache.init_app(app)
+    revocation_index.init_app(app)
 
     if app.config["CORS"]:
         app.config["CORS_HEADERS"] = "Content-Type"
@@ -159,16 +184,26 @@ def configure_blueprints(app, blueprints):
 
 
 def configure_database(app):
-    if app.config.get("SQLALCHEMY_ENABLE_FLASK_REPLICATED"):
-        FlaskReplicated(app)
+    # reads of GET requests go to SQLALCHEMY_BINDS["reader"], if configured
+    read_router.init_app(app)
+
+    # no-op unless we run in a gevent worker
+    patch_drivers(app)
 
 
 def configure_logging(app):
     """
     Sets up application wide logging.
 
+    Records go through a bounded queue (LOG_QUEUE_SIZE) to a single writer
+    thread, which formats them and writes the file and the stream. A request
+    never waits on logging: when the queue is full, records are dropped and
+    counted.
+
     :param app:
     """
+    level = app.config.get("LOG_LEVEL", "INFO")
+
     handler = RotatingFileHandler(
         app.config.get("LOG_FILE", "horseradish.log"),
         maxBytes=10000000,
@@ -186,13 +221,17 @@ def configure_logging(app):
             logmatic.JsonFormatter(extra={"hostname": socket.gethostname()})
         )
 
-    handler.setLevel(app.config.get("LOG_LEVEL", "DEBUG"))
-    app.logger.setLevel(app.config.get("LOG_LEVEL", "DEBUG"))
-    app.logger.addHandler(handler)
+    handler.setLevel(level)
 
     stream_handler = StreamHandler()
-    stream_handler.setLevel(app.config.get("LOG_LEVEL", "DEBUG"))
-    app.logger.addHandler(stream_handler)
+    stream_handler.setLevel(level)
+
+    queue_handler = BoundedQueueHandler(
+        [handler, stream_handler], maxsize=app.config.get("LOG_QUEUE_SIZE", 10000)
+    )
+    queue_handler.setLevel(level)
+    app.logger.setLevel(level)
+    app.logger.addHandler(queue_handler)
 
     if app.config.get("DEBUG_DUMP", False):
         pass
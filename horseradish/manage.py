@@ -3,6 +3,7 @@ from __future__ import unicode_literals  # at top of module
 
 import os
 import sys
+import time
 import base64
 
 # import requests
@@ -10,7 +11,10 @@ import base64
 
 from gunicorn.config import make_settings
 
-from cryptography.fernet import Fernet
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
 from flask import current_app
 from flask_script import Manager, Command, Option, prompt_pass
@@ -20,14 +24,18 @@ from flask_script.commands import ShowUrls, Clean, Server
 from horseradish import database
 from horseradish.users import service as user_service
 from horseradish.roles import service as role_service
-from horseradish.common.utils import validate_conf
+from horseradish.roles.models import Role
+from horseradish.api_keys.cli import manager as api_key_manager
+from horseradish.common.utils import validate_conf, windowed_query
+from horseradish.utils import get_keys
 
 from horseradish import create_app
 
 # Import models for SQLAlchemy
 """ implement later """
 
-from sqlalchemy.sql import text
+from sqlalchemy import LargeBinary, and_, type_coerce
+from sqlalchemy.sql import text, bindparam, select
 
 manager = Manager(create_app)
 manager.add_option("-c", "--config", dest="config_path", required=False)
@@ -262,6 +270,173 @@ class CreateRole(Command):
         sys.stdout.write("[+] Created new role: {0}".format(name))
 
 
+_rotation_keys = None
+
+
+def _init_rotation_worker(keys):
+    global _rotation_keys
+    _rotation_keys = (
+        Fernet(keys[0]),
+        MultiFernet([Fernet(key) for key in keys]),
+    )
+
+
+def _rotate_batch(rows):
+    """
+    Re-encrypts a batch of (id, ciphertext) rows under the primary key.
+    Rows that are already encrypted with the primary key are skipped, so
+    that a rotation can be re-run cheaply.
+
+    :param rows:
+    :return: list of (id, old ciphertext, new ciphertext) to write back,
+        number of rows seen
+    """
+    primary, key_ring = _rotation_keys
+    rotated = []
+    for row_id, token in rows:
+        try:
+            primary.decrypt(token)
+            continue
+        except InvalidToken:
+            pass
+        rotated.append((row_id, token, key_ring.rotate(token)))
+    return rotated, len(rows)
+
+
+class RotateEncryptionKeys(Command):
+    """
+    This command re-encrypts every encrypted role password with the first of
+    the HORSERADISH_ENCRYPTION_KEYS, so that the older keys can be retired.
+
+    Rows are streamed in primary key windows and re-encrypted by a pool of
+    worker processes. Each batch is written back with a single executemany
+    UPDATE in its own short transaction, so the table is never locked as a
+    whole. The last committed id is reported as progress; pass it as
+    --start-id to resume an interrupted run.
+
+    A row is only written back if it still holds the ciphertext that was
+    read. Passwords changed meanwhile are already encrypted with the primary
+    key; they are left alone and reported.
+    """
+
+    option_list = (
+        Option("-b", "--batch-size", dest="batch_size", type=int, default=500),
+        Option("-w", "--workers", dest="workers", type=int, default=os.cpu_count()),
+        Option("-s", "--start-id", dest="start_id", type=int, default=0),
+        Option(
+            "-t",
+            "--throttle",
+            dest="throttle",
+            type=float,
+            default=0,
+            help="Seconds to sleep after writing each batch.",
+        ),
+    )
+
+    def run(self, batch_size, workers, start_id, throttle):
+        keys = get_keys()
+        if len(keys) < 2:
+            sys.stdout.write("[-] Only one encryption key configured, nothing to do.\n")
+            return
+
+        session = database.db.session
+        # also bounds the window query, so a resumed run doesn't number every row
+        pending = and_(Role.password.isnot(None), Role.id >= start_id)
+        query = session.query(Role.id, type_coerce(Role.password, LargeBinary)).filter(
+            pending
+        )
+        total = query.count()
+        sys.stdout.write(
+            "[+] Re-encrypting {0} role passwords from id {1}\n".format(total, start_id)
+        )
+
+        table = Role.__table__
+        # compare and write the raw ciphertext, bypassing Vault
+        password = type_coerce(table.c.password, LargeBinary)
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .where(password == bindparam("_old", type_=LargeBinary))
+            .values(password=bindparam("_password", type_=LargeBinary))
+        )
+
+        def changed_meanwhile(connection, rotated):
+            # the rows, if any left, that don't hold the ciphertext we just wrote
+            expected = {i: new for i, old, new in rotated}
+            current = {
+                i: bytes(token)
+                for i, token in connection.execute(
+                    select([table.c.id, password]).where(table.c.id.in_(expected))
+                )
+            }
+            return sorted(i for i in expected if current.get(i) != expected[i])
+
+        seen = written = skipped = 0
+        # batches in submission order, written back oldest first so that the
+        # reported checkpoint only ever covers committed rows
+        in_flight = deque()
+        max_in_flight = max(workers, 1) * 2
+
+        def write_oldest():
+            nonlocal seen, written, skipped
+            last_id, future = in_flight.popleft()
+            rotated, count = future.result()
+            if rotated:
+                # a separate, short transaction; the read session keeps streaming
+                with database.db.engine.begin() as connection:
+                    result = connection.execute(
+                        statement,
+                        [
+                            dict(_id=i, _old=old, _password=new)
+                            for i, old, new in rotated
+                        ],
+                    )
+                    changed = []
+                    if result.rowcount != len(rotated):
+                        changed = changed_meanwhile(connection, rotated)
+                if changed:
+                    sys.stdout.write(
+                        "[!] Skipped role ids changed since they were read: "
+                        "{0}\n".format(", ".join(str(i) for i in changed))
+                    )
+                written += len(rotated) - len(changed)
+                skipped += len(changed)
+            seen += count
+            sys.stdout.write(
+                "[+] {0}/{1} rows checked, {2} re-encrypted. "
+                "Resume with --start-id {3}\n".format(seen, total, written, last_id + 1)
+            )
+            if throttle:
+                time.sleep(throttle)
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_rotation_worker,
+            initargs=(keys,),
+        ) as executor:
+            batch = []
+            for row_id, token in windowed_query(query, Role.id, batch_size, pending):
+                batch.append((row_id, bytes(token)))
+                if len(batch) < batch_size:
+                    continue
+
+                in_flight.append((row_id, executor.submit(_rotate_batch, batch)))
+                batch = []
+                if len(in_flight) >= max_in_flight:
+                    write_oldest()
+
+            if batch:
+                in_flight.append((batch[-1][0], executor.submit(_rotate_batch, batch)))
+            while in_flight:
+                write_oldest()
+
+        session.remove()
+        sys.stdout.write(
+            "[/] Done! {0} role passwords re-encrypted, {1} skipped as changed "
+            "meanwhile.\n".format(written, skipped)
+        )
+
+
 class HorseradishServer(Command):
     """
     This is the main Horseradish server, it runs the flask app with gunicorn and
@@ -271,6 +446,10 @@ class HorseradishServer(Command):
     For example:
     horseradish start -w 4 -b 127.0.0.0:8002
     Will start gunicorn with 4 workers bound to 127.0.0.0:8002
+
+    HORSERADISH_WORKER_CLASS and HORSERADISH_WORKER_CONNECTIONS set the worker
+    class (e.g. gevent) and its concurrency when they aren't given on the
+    command line. See docs/production.md for sizing the pools.
     """
 
     description = "Run the app within Gunicorn"
@@ -304,6 +483,15 @@ class HorseradishServer(Command):
             current_app.config.get("CONFIG_PATH")
         )
 
+        # command line flags win over the configuration
+        worker_class = current_app.config.get("HORSERADISH_WORKER_CLASS")
+        if worker_class and app.cfg.worker_class_str == "sync":
+            app.cfg.set("worker_class", worker_class)
+
+        worker_connections = current_app.config.get("HORSERADISH_WORKER_CONNECTIONS")
+        if worker_connections and app.cfg.worker_connections == 1000:
+            app.cfg.set("worker_connections", worker_connections)
+
         return app.run()
 
 
@@ -419,6 +607,8 @@ def main():
     manager.add_command("create_user", CreateUser())
     manager.add_command("reset_password", ResetPassword())
     manager.add_command("create_role", CreateRole())
+    manager.add_command("rotate_encryption_keys", RotateEncryptionKeys())
+    manager.add_command("api_keys", api_key_manager)
     manager.run()
 
 
@@ -3,18 +3,62 @@
     :copyright: (c) 2020 by Sam Havron, see AUTHORS for more
     :license: Apache, see LICENSE for more details.
 """
+import os
+import time
+import atexit
+import threading
+
 from flask import current_app
 from horseradish.plugins.base import plugins
 
+HISTOGRAM_TYPES = ("histogram", "timer")
+HISTOGRAM_PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, pct):
+    """
+    Nearest-rank percentile of an already sorted list of samples.
+
+    :param samples:
+    :param pct:
+    :return:
+    """
+    rank = max(int(round(pct / 100.0 * len(samples))) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
 
 class Metrics(object):
     """
+    Collects metrics in memory and hands them to the ``METRIC_PROVIDERS`` from a
+    background thread, so that sending a metric never waits on a metrics
+    backend.
+
+    Points are aggregated per name, type and tags over ``METRIC_FLUSH_INTERVAL``
+    seconds: counters are summed, gauges keep their last value and histograms
+    (or timers) are reduced to count, avg, max and percentiles. Each flush hands
+    the whole batch to every provider's ``submit_many``.
+
+    The buffer holds at most ``METRIC_BUFFER_SIZE`` series and
+    ``METRIC_MAX_SAMPLES`` samples per histogram. When it is full, points for
+    new series and extra samples are dropped; the number of dropped points is
+    reported as the ``metrics.dropped`` counter.
+
     :param app: The Flask application object. Defaults to None.
     """
 
     _providers = []
 
     def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock()
+        self._series = {}
+        self._dropped = 0
+        self._thread = None
+        self._pid = None
+        self.flush_interval = 10
+        self.buffer_size = 10000
+        self.max_samples = 1000
+
         if app is not None:
             self.init_app(app)
 
@@ -23,17 +67,130 @@ class Metrics(object):
 
         :param app: The Flask application object.
         """
+        if self._app is None:
+            atexit.register(self.flush)
+
+        self._app = app
         self._providers = app.config.get("METRIC_PROVIDERS", [])
+        self.flush_interval = app.config.get("METRIC_FLUSH_INTERVAL", 10)
+        self.buffer_size = app.config.get("METRIC_BUFFER_SIZE", 10000)
+        self.max_samples = app.config.get("METRIC_MAX_SAMPLES", 1000)
 
     def send(self, metric_name, metric_type, metric_value, *args, **kwargs):
-        print(
-            f"METRIC {metric_name} ({metric_type}) = {metric_value} ({args}, {kwargs})"
-        )
-        for provider in self._providers:
-            current_app.logger.debug(
-                "Sending metric '{metric}' to the {provider} provider.".format(
-                    metric=metric_name, provider=provider
-                )
+        """
+        Queues a metric point. Never blocks on the providers.
+
+        :param metric_name:
+        :param metric_type: counter, gauge, histogram or timer
+        :param metric_value:
+        :param metric_tags: dict of tags, optional
+        """
+        if not self._providers:
+            return
+
+        tags = kwargs.get("metric_tags") or {}
+        key = (metric_name, metric_type, tuple(sorted(tags.items())))
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                if len(self._series) >= self.buffer_size:
+                    self._dropped += 1
+                    return
+                series = [] if metric_type in HISTOGRAM_TYPES else 0
+                self._series[key] = series
+
+            if metric_type in HISTOGRAM_TYPES:
+                if len(series) >= self.max_samples:
+                    self._dropped += 1
+                else:
+                    series.append(metric_value)
+            elif metric_type == "counter":
+                self._series[key] = series + metric_value
+            else:
+                self._series[key] = metric_value
+
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        # (re)start the flusher in every process, e.g. after a gunicorn fork
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="horseradish-metrics", daemon=True
             )
-            p = plugins.get(provider)
-            p.submit(metric_name, metric_type, metric_value, *args, **kwargs)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # the flusher must survive a misbehaving provider
+                pass
+
+    def _drain(self):
+        """
+        Swaps the buffer for an empty one and turns the aggregated series into
+        a list of (name, type, value, tags).
+        """
+        with self._lock:
+            series, self._series = self._series, {}
+            dropped, self._dropped = self._dropped, 0
+
+        batch = []
+        for (name, metric_type, tags), value in series.items():
+            tags = dict(tags)
+            if metric_type not in HISTOGRAM_TYPES:
+                batch.append((name, metric_type, value, tags))
+                continue
+
+            if not value:
+                continue
+            samples = sorted(value)
+            batch.append((name + ".count", "counter", len(samples), tags))
+            batch.append((name + ".avg", "gauge", sum(samples) / len(samples), tags))
+            batch.append((name + ".max", "gauge", samples[-1], tags))
+            for pct in HISTOGRAM_PERCENTILES:
+                batch.append(
+                    (
+                        name + ".p{0}".format(pct),
+                        "gauge",
+                        percentile(samples, pct),
+                        tags,
+                    )
+                )
+
+        if dropped:
+            batch.append(("metrics.dropped", "counter", dropped, {}))
+        return batch
+
+    def flush(self):
+        """
+        Submits everything collected so far to every provider.
+        """
+        batch = self._drain()
+        if not batch or self._app is None:
+            return
+
+        with self._app.app_context():
+            for provider in self._providers:
+                current_app.logger.debug(
+                    "Sending {count} metrics to the {provider} provider.".format(
+                        count=len(batch), provider=provider
+                    )
+                )
+                try:
+                    plugins.get(provider).submit_many(batch)
+                except Exception as e:
+                    current_app.logger.error(
+                        "Unable to send metrics to the {provider} provider: {error}".format(
+                            provider=provider, error=e
+                        )
+                    )
@@ -0,0 +1,38 @@
+"""Add the token revocation log
+
+Revision ID: 4db6bd2e50d8
+Revises: f4fac47fc769
+Create Date: 2020-12-21 15:02:11.730412
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "4db6bd2e50d8"
+down_revision = "f4fac47fc769"
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        "token_revocations",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("api_key_id", sa.Integer(), nullable=True),
+        sa.Column("user_id", sa.Integer(), nullable=True),
+        sa.Column(
+            "changed_at",
+            sa.BigInteger(),
+            nullable=False,
+            server_default=sa.text("extract(epoch FROM clock_timestamp())::bigint"),
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_token_revocations_changed_at", "token_revocations", ["changed_at"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_token_revocations_changed_at", "token_revocations")
+    op.drop_table("token_revocations")
@@ -0,0 +1,44 @@
+"""Add GIN trigram indexes for the searchable columns
+
+Revision ID: f4fac47fc769
+Revises:
+Create Date: 2020-12-14 10:21:37.482911
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = "f4fac47fc769"
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+# (table, column) pairs, see the `searchable_fields` of each model
+SEARCHABLE = (
+    ("users", "username"),
+    ("users", "email"),
+    ("roles", "name"),
+    ("roles", "description"),
+)
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    # build the indexes without locking the tables against writes
+    with op.get_context().autocommit_block():
+        for table, column in SEARCHABLE:
+            op.execute(
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{0}_{1}_trgm "
+                "ON {0} USING gin ({1} gin_trgm_ops)".format(table, column)
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, column in SEARCHABLE:
+            op.execute(
+                "DROP INDEX CONCURRENTLY IF EXISTS ix_{0}_{1}_trgm".format(
+                    table, column
+                )
+            )
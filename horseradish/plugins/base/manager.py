@@ -11,37 +11,56 @@ from horseradish.common.managers import InstanceManager
 
 # inspired by https://github.com/getsentry/sentry
 class PluginManager(InstanceManager):
+    """
+    Keeps the enabled plugins indexed by slug and by (type, version), sorted
+    by title. The index is rebuilt only when the instance cache is, i.e. after
+    ``add``, ``remove`` or ``update`` changed the class list.
+    """
+
+    _index = None
+
     def __iter__(self):
         return iter(self.all())
 
     def __len__(self):
-        return sum(1 for i in self.all())
+        return len(self._get_index()[1][(None, 1)])
+
+    def _get_index(self):
+        instances = super(PluginManager, self).all()
+        index = self._index
+        if index is not None and index[0] is instances:
+            return index
+
+        enabled = sorted(
+            (p for p in instances if p.is_enabled()), key=lambda x: x.get_title()
+        )
+
+        lists = {}
+        for plugin in enabled:
+            for plugin_type in (None, plugin.type):
+                for version in (None, plugin.__version__):
+                    lists.setdefault((plugin_type, version), []).append(plugin)
+        lists.setdefault((None, 1), [])
+
+        # version 1 plugins take precedence over version 2 plugins
+        slugs = {}
+        for version in (2, 1):
+            for plugin in lists.get((None, version), []):
+                slugs[plugin.slug] = plugin
+
+        index = self._index = (instances, lists, slugs)
+        return index
 
     def all(self, version=1, plugin_type=None):
-        for plugin in sorted(
-            super(PluginManager, self).all(), key=lambda x: x.get_title()
-        ):
-            if not plugin.type == plugin_type and plugin_type:
-                continue
-            if not plugin.is_enabled():
-                continue
-            if version is not None and plugin.__version__ != version:
-                continue
-            yield plugin
+        _, lists, _ = self._get_index()
+        return iter(lists.get((plugin_type or None, version), ()))
 
     def get(self, slug):
-        for plugin in self.all(version=1):
-            if plugin.slug == slug:
-                return plugin
-        for plugin in self.all(version=2):
-            if plugin.slug == slug:
-                return plugin
-        current_app.logger.error(
-            "Unable to find slug: {} in self.all version 1: {} or version 2: {}".format(
-                slug, self.all(version=1), self.all(version=2)
-            )
-        )
-        raise KeyError(slug)
+        plugin = self._get_index()[2].get(slug)
+        if plugin is None:
+            current_app.logger.error("Unable to find plugin slug: {}".format(slug))
+            raise KeyError(slug)
+        return plugin
 
     def first(self, func_name, *args, **kwargs):
         version = kwargs.pop("version", 1)
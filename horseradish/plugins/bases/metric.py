@@ -16,3 +16,22 @@ class MetricPlugin(Plugin):
         self, metric_name, metric_type, metric_value, metric_tags=None, options=None
     ):
         raise NotImplementedError
+
+    def submit_many(self, metrics, options=None):
+        """
+        Submits a batch of aggregated metrics, as collected by
+        :class:`horseradish.metrics.Metrics` over one flush interval. Providers
+        whose backend accepts batches should override this; the default
+        submits them one by one.
+
+        :param metrics: list of (metric_name, metric_type, metric_value, metric_tags)
+        :param options:
+        """
+        for metric_name, metric_type, metric_value, metric_tags in metrics:
+            self.submit(
+                metric_name,
+                metric_type,
+                metric_value,
+                metric_tags=metric_tags,
+                options=options,
+            )
@@ -9,10 +9,10 @@
 .. moduleauthor:: Sam Havron <havron@hey.com>
 
 """
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy import Boolean, Column, Integer, String, Text, ForeignKey
 
-from horseradish.database import db
+from horseradish.database import db, trigram_indexes
 from horseradish.utils import Vault
 from horseradish.models import (
     roles_users,
@@ -24,7 +24,8 @@ class Role(db.Model):
     id = Column(Integer, primary_key=True)
     name = Column(String(128), unique=True)
     username = Column(String(128))
-    password = Column(Vault)
+    # only decrypted when read, not for every role that is listed
+    password = deferred(Column(Vault))
     description = Column(Text)
     user_id = Column(Integer, ForeignKey("users.id"))
     third_party = Column(Boolean)
@@ -33,6 +34,10 @@ class Role(db.Model):
     )
 
     sensitive_fields = ("password",)
+    searchable_fields = ("name", "description")
 
     def __repr__(self):
         return "Role(name={name})".format(name=self.name)
+
+
+trigram_indexes(Role)
@@ -9,9 +9,20 @@
 
 .. moduleauthor:: Sam Havron <havron@hey.com>
 """
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
 from horseradish import database
 from horseradish.roles.models import Role
 from horseradish.users.models import User
+from horseradish.auth.cache import invalidate_all
+from horseradish.api_keys.revocations import record_change
+from horseradish.common.cache import TTLCache
+
+# role name -> role id, HORSERADISH_ROLE_CACHE_SIZE / HORSERADISH_ROLE_CACHE_TTL
+role_ids = TTLCache(maxsize=4096, ttl=300, config_prefix="HORSERADISH_ROLE_CACHE")
 
 
 def update(role_id, name, description, users):
@@ -28,7 +39,10 @@ def update(role_id, name, description, users):
     role.name = name
     role.description = description
     role.users = users
+    record_change()
     database.update(role)
+    role_ids.clear()
+    invalidate_all()
     return role
 
 
@@ -94,6 +108,99 @@ def get_by_name(role_name):
     return database.get(Role, role_name, field="name")
 
 
+def _find_by_names(names):
+    """
+    Loads the roles with the given names in one query, going through the
+    primary key for the names we already know the id of.
+
+    :param names:
+    :return: dict of role name -> role
+    """
+    ids, unknown = [], []
+    for name in names:
+        role_id = role_ids.get(name)
+        if role_id is None:
+            unknown.append(name)
+        else:
+            ids.append(role_id)
+
+    clauses = []
+    if ids:
+        clauses.append(Role.id.in_(ids))
+    if unknown:
+        clauses.append(Role.name.in_(unknown))
+    if not clauses:
+        return {}
+
+    # the roles may be updated or assigned right after, read them on the primary
+    found = {}
+    for role in database.db.session.query(Role).filter(or_(*clauses)):
+        role_ids.set(role.name, role.id)
+        if role.name in names:
+            found[role.name] = role
+
+    # a cached id may point to a role that was renamed or deleted since
+    stale = [name for name in names if name not in found and name not in unknown]
+    if stale:
+        for name in stale:
+            role_ids.pop(name)
+        found.update(_find_by_names(stale))
+    return found
+
+
+def resolve(names, create=None):
+    """
+    Looks up many roles by name at once, creates the missing ones and marks
+    them all as third party roles. Used to map identity provider groups to
+    roles at login.
+
+    Existing roles are fetched with a single IN query, missing roles are
+    inserted and ``third_party`` is set with a single UPDATE. Nothing is
+    committed: the changes go out with the caller's transaction, usually
+    together with the user they are assigned to.
+
+    :param names: names of roles to look up, they are skipped when missing
+    :param create: dict of role name -> description, for roles to create when
+        missing
+    :return: dict of role name -> role
+    """
+    create = create or {}
+    names = set(names) | set(create)
+    if not names:
+        return {}
+
+    roles = _find_by_names(names)
+
+    missing = [name for name in create if name not in roles]
+    if missing:
+        new_roles = [
+            Role(name=name, description=create[name], third_party=True)
+            for name in missing
+        ]
+        try:
+            with database.db.session.begin_nested():
+                database.db.session.add_all(new_roles)
+        except IntegrityError:
+            # another login created some of them in the meantime
+            roles = _find_by_names(names)
+            if any(name not in roles for name in create):
+                raise
+            new_roles = []
+        for role in new_roles:
+            role_ids.set(role.name, role.id)
+            roles[role.name] = role
+
+    flip = [role for role in roles.values() if not role.third_party]
+    if flip:
+        database.db.session.query(Role).filter(
+            Role.id.in_([role.id for role in flip])
+        ).update({Role.third_party: True}, synchronize_session=False)
+        for role in flip:
+            set_committed_value(role, "third_party", True)
+
+    return roles
+
+
 def delete(role_id):
     """
     Remove a role
@@ -101,7 +208,11 @@ def delete(role_id):
     :param role_id:
     :return:
     """
-    return database.delete(get(role_id))
+    record_change()
+    result = database.delete(get(role_id))
+    role_ids.clear()
+    invalidate_all()
+    return result
 
 
 def render(args):
@@ -112,7 +223,10 @@ def render(args):
     :param args:
     :return:
     """
-    query = database.session_query(Role)
+    # the output schema nests each role's users, but not their roles
+    query = database.session_query(Role).options(
+        selectinload(Role.users).lazyload(User.roles)
+    )
     filt = args.pop("filter")
     user_id = args.pop("user_id", None)
     authority_id = args.pop("authority_id", None)
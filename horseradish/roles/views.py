@@ -16,7 +16,7 @@ from horseradish.auth.service import AuthenticatedResource
 from horseradish.auth.permissions import RoleMemberPermission, admin_permission
 from horseradish.common.utils import paginated_parser
 
-from horseradish.common.schema import validate_schema
+from horseradish.common.schema import validate_schema, wants_stream
 from horseradish.roles.schemas import (
     role_input_schema,
     role_output_schema,
@@ -79,6 +79,11 @@ class RolesList(AuthenticatedResource):
            :query page: int default is 1
            :query filter: key value pair format is k;v
            :query count: count number default is 10
+           :query cursor: opaque keyset cursor, empty for the first page. Pages
+               by the sort column and id instead of by page number, and returns
+               nextCursor for the following page
+           :query total: exact, estimate, cached or none. default is exact, or none with a cursor
+           :query stream: write the items out as they are read, implied by Accept: application/x-ndjson
            :reqheader Authorization: OAuth token to authenticate
            :statuscode 200: no error
            :statuscode 403: unauthenticated
@@ -88,7 +93,8 @@ class RolesList(AuthenticatedResource):
         parser.add_argument("id", type=str, location="args")
 
         args = parser.parse_args()
-        args["user"] = g.current_user
+        args["stream"] = wants_stream(args)
+        args["user"] = g.current_user_id
         return service.render(args)
 
     @admin_permission.require(http_exception=403)
@@ -382,11 +388,17 @@ class UserRolesList(AuthenticatedResource):
            :query page: int default is 1
            :query filter: key value pair format is k;v
            :query count: count number default is 10
+           :query cursor: opaque keyset cursor, empty for the first page. Pages
+               by the sort column and id instead of by page number, and returns
+               nextCursor for the following page
+           :query total: exact, estimate, cached or none. default is exact, or none with a cursor
+           :query stream: write the items out as they are read, implied by Accept: application/x-ndjson
            :reqheader Authorization: OAuth token to authenticate
            :statuscode 200: no error
         """
         parser = paginated_parser.copy()
         args = parser.parse_args()
+        args["stream"] = wants_stream(args)
         args["user_id"] = user_id
         return service.render(args)
 
@@ -442,11 +454,17 @@ class AuthorityRolesList(AuthenticatedResource):
            :query page: int default is 1
            :query filter: key value pair format is k;v
            :query count: count number default is 10
+           :query cursor: opaque keyset cursor, empty for the first page. Pages
+               by the sort column and id instead of by page number, and returns
+               nextCursor for the following page
+           :query total: exact, estimate, cached or none. default is exact, or none with a cursor
+           :query stream: write the items out as they are read, implied by Accept: application/x-ndjson
            :reqheader Authorization: OAuth token to authenticate
            :statuscode 200: no error
         """
         parser = paginated_parser.copy()
         args = parser.parse_args()
+        args["stream"] = wants_stream(args)
         args["authority_id"] = authority_id
         return service.render(args)
 
@@ -14,10 +14,10 @@ from sqlalchemy.event import listen
 
 from sqlalchemy_utils.types.arrow import ArrowType
 
-from horseradish.database import db
+from horseradish.database import db, trigram_indexes
 from horseradish.models import roles_users
 
-from horseradish.extensions import bcrypt
+from horseradish.auth.passwords import password_hasher
 
 
 def hash_password(mapper, connect, target):
@@ -41,15 +41,19 @@ class User(db.Model):
     username = Column(String(255), nullable=False, unique=True)
     email = Column(String(128), unique=True)
     profile_picture = Column(String(255))
+    # roles are needed for nearly every user we load (identity needs,
+    # is_admin, the output schema), so they are fetched with one extra
+    # SELECT ... WHERE user_id IN (...) per query rather than once per user
     roles = relationship(
         "Role",
         secondary=roles_users,
         passive_deletes=True,
         backref=db.backref("user"),
-        lazy="dynamic",
+        lazy="selectin",
     )
 
     sensitive_fields = ("password",)
+    searchable_fields = ("username", "email")
 
     def check_password(self, password):
         """
@@ -60,7 +64,7 @@ class User(db.Model):
         :return:
         """
         if self.password:
-            return bcrypt.check_password_hash(self.password, password)
+            return password_hasher.check(self.password, password)
 
     def hash_password(self):
         """
@@ -69,7 +73,7 @@ class User(db.Model):
         :return:
         """
         if self.password:
-            self.password = bcrypt.generate_password_hash(self.password).decode("utf-8")
+            self.password = password_hasher.hash(self.password)
 
     @property
     def is_admin(self):
@@ -88,3 +92,4 @@ class User(db.Model):
 
 
 listen(User, "before_insert", hash_password)
+trigram_indexes(User)
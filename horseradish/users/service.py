@@ -9,6 +9,9 @@
 """
 from horseradish import database
 from horseradish.users.models import User
+from horseradish.auth.cache import invalidate_user
+from horseradish.api_keys.revocations import record_change
+from horseradish.auth.passwords import password_hasher, PasswordHashingBusy
 
 
 def create(username, password, email, active, profile_picture, roles):
@@ -47,12 +50,20 @@ def update(user_id, username, email, active, profile_picture, roles):
     :return:
     """
     user = get(user_id)
+    # cached tokens only depend on whether the user is active and its roles;
+    # SSO and LDAP logins call this every time, mostly without changing either
+    changed = user.active != active
     user.username = username
     user.email = email
     user.active = active
     user.profile_picture = profile_picture
-    update_roles(user, roles)
-    return database.update(user)
+    changed = update_roles(user, roles) or changed
+    if changed:
+        record_change(user_id=user.id)
+    user = database.update(user)
+    if changed:
+        invalidate_user(user.id)
+    return user
 
 
 def update_roles(user, roles):
@@ -61,22 +72,44 @@ def update_roles(user, roles):
     when are roles added as well as when there are roles
     removed.
 
+    The difference is computed on role ids and applied to the collection, so
+    that the unit of work flushes the association rows and the inverse
+    collections of loaded roles stay in sync.
+
     :param user:
     :param roles:
+    :return: whether the roles changed
+    """
+    current = {ur.id: ur for ur in user.roles}
+    new = {r.id: r for r in roles}
+
+    for role_id in current.keys() - new.keys():
+        user.roles.remove(current[role_id])
+
+    for role_id in new.keys() - current.keys():
+        user.roles.append(new[role_id])
+
+    return current.keys() != new.keys()
+
+
+def rehash_password(user, password):
+    """
+    Upgrades the stored hash of a user to the configured bcrypt cost. Meant
+    to be called right after a successful login, while we still have the
+    password at hand.
+
+    :param user:
+    :param password:
     """
-    for ur in user.roles:
-        for r in roles:
-            if r.id == ur.id:
-                break
-        else:
-            user.roles.remove(ur)
-
-    for r in roles:
-        for ur in user.roles:
-            if r.id == ur.id:
-                break
-        else:
-            user.roles.append(r)
+    if not password_hasher.needs_rehash(user.password):
+        return
+
+    try:
+        user.password = password_hasher.hash(password)
+    except PasswordHashingBusy:
+        # not worth failing a login over, we'll do it next time
+        return
+    database.update(user)
 
 
 def get(user_id):
@@ -8,7 +8,7 @@
 from flask import g, Blueprint
 from flask_restful import reqparse, Api
 
-from horseradish.common.schema import validate_schema
+from horseradish.common.schema import validate_schema, wants_stream
 from horseradish.common.utils import paginated_parser
 
 from horseradish.auth.service import AuthenticatedResource
@@ -83,6 +83,11 @@ class UsersList(AuthenticatedResource):
            :query page: int default is 1
            :query filter: key value pair format is k;v
            :query count: count number default is 10
+           :query cursor: opaque keyset cursor, empty for the first page. Pages
+               by the sort column and id instead of by page number, and returns
+               nextCursor for the following page
+           :query total: exact, estimate, cached or none. default is exact, or none with a cursor
+           :query stream: write the items out as they are read, implied by Accept: application/x-ndjson
            :reqheader Authorization: OAuth token to authenticate
            :statuscode 200: no error
         """
@@ -90,6 +95,7 @@ class UsersList(AuthenticatedResource):
         parser.add_argument("owner", type=str, location="args")
         parser.add_argument("id", type=str, location="args")
         args = parser.parse_args()
+        args["stream"] = wants_stream(args)
         return service.render(args)
 
     @admin_permission.require(http_exception=403)
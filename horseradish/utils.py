@@ -8,6 +8,7 @@
 import os
 import tempfile
 from contextlib import contextmanager
+from functools import lru_cache
 
 from sqlalchemy import types
 from cryptography.fernet import Fernet, MultiFernet
@@ -68,6 +69,61 @@ def get_keys():
     return keys
 
 
+@lru_cache(maxsize=8)
+def _build_key_ring(keys):
+    # we assume that the user's keys are already Fernet keys (32 byte
+    # keys that have been base64 encoded).
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def get_key_ring():
+    """
+    Returns the MultiFernet for the current encryption keys.
+
+    Parsing the keys is done once per distinct set of keys and shared across
+    rows and threads. Since the cache is keyed on the keys themselves, a
+    rotated HORSERADISH_ENCRYPTION_KEYS takes effect as soon as the config
+    carries it.
+
+    :return:
+    """
+    return _build_key_ring(tuple(get_keys()))
+
+
+def encrypt(value, key_ring=None):
+    """
+    Encrypts a value with the first key.
+
+    :param value: str or bytes
+    :param key_ring:
+    :return:
+    """
+    if not value:
+        return
+
+    # ensure bytes for fernet
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+
+    return (key_ring or get_key_ring()).encrypt(value)
+
+
+def decrypt(value, key_ring=None):
+    """
+    Decrypts a value, trying each key until one works.
+
+    :param value:
+    :param key_ring:
+    :return:
+    """
+    # if the value is not a string we aren't going to try to decrypt
+    # it. this is for the case where the column is null
+    if not value:
+        return
+
+    return (key_ring or get_key_ring()).decrypt(value).decode("utf8")
+
+
 class Vault(types.TypeDecorator):
     """
     A custom SQLAlchemy column type that transparently handles encryption.
@@ -89,19 +145,7 @@ class Vault(types.TypeDecorator):
 
         MultiFernet.encrypt uses the first key in the list.
         """
-
-        # we assume that the user's keys are already Fernet keys (32 byte
-        # keys that have been base64 encoded).
-        self.keys = [Fernet(key) for key in get_keys()]
-
-        if not value:
-            return
-
-        # ensure bytes for fernet
-        if isinstance(value, str):
-            value = value.encode("utf-8")
-
-        return MultiFernet(self.keys).encrypt(value)
+        return encrypt(value)
 
     def process_result_value(self, value, dialect):
         """
@@ -109,14 +153,4 @@ class Vault(types.TypeDecorator):
 
         MultiFernet tries each key until one works.
         """
-
-        # we assume that the user's keys are already Fernet keys (32 byte
-        # keys that have been base64 encoded).
-        self.keys = [Fernet(key) for key in get_keys()]
-
-        # if the value is not a string we aren't going to try to decrypt
-        # it. this is for the case where the column is null
-        if not value:
-            return
-
-        return MultiFernet(self.keys).decrypt(value).decode("utf8")
+        return decrypt(value)